@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+"""
+The tests only cover the modules that don't depend on QGIS (vectorbendercore.py and vectorbendercli.py), which are
+imported directly from the plugin directory rather than as a package (whose __init__.py needs QGIS).
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+import sqlite3
+import struct
+
+import numpy
+import pytest
+
+import vectorbendercli
+from vectorbendercore import Model, TranslationModel
+
+
+def translation(dx=10.0, dy=-5.0):
+    return TranslationModel([0.0], [0.0], [dx], [dy])
+
+def writePairs(path, pairs):
+    features = [ {"type": "Feature", "properties": {}, "geometry": {"type": "LineString", "coordinates": [[ax, ay], [bx, by]]}} for ax, ay, bx, by in pairs ]
+    path.write_text( json.dumps({"type": "FeatureCollection", "features": features}) )
+    return str(path)
+
+# Polygon Z (ISO type 1003), little endian
+POLYGON_Z = struct.pack('<BII', 1, 1003, 1)+struct.pack('<I', 4)+struct.pack('<12d', 0,0,7, 10,0,8, 10,10,9, 0,0,7)
+# MultiPoint with a big endian point and a little endian point
+MULTIPOINT = struct.pack('>BII', 0, 4, 2)+struct.pack('>BI2d', 0, 1, 1.0, 2.0)+struct.pack('<BI2d', 1, 1, 3.0, 4.0)
+# Empty point (NaN coordinates)
+EMPTY_POINT = struct.pack('<BI2d', 1, 1, float('nan'), float('nan'))
+# EWKB LineString M with a SRID
+LINESTRING_M = struct.pack('<BIi', 1, 0x40000002 | 0x20000000, 2056)+struct.pack('<I', 2)+struct.pack('<6d', 1,2,100, 3,4,200)
+
+
+def testWkbRoundTrip():
+    for wkb in (POLYGON_Z, MULTIPOINT, EMPTY_POINT, LINESTRING_M):
+        newWkb, xs, ys, end = vectorbendercli.mapWkb(Model(), wkb)
+        assert newWkb == wkb and end == len(wkb)
+
+def testWkbMapping():
+    newWkb, xs, ys, _ = vectorbendercli.mapWkb(translation(), POLYGON_Z)
+    assert struct.unpack_from('<12d', newWkb, 13) == (10,-5,7, 20,-5,8, 20,5,9, 10,-5,7)
+    assert list(xs) == [10, 20, 20, 10]
+
+    # The coordinates are returned in vertex order whatever the byte order of each point
+    newWkb, xs, ys, _ = vectorbendercli.mapWkb(translation(), MULTIPOINT)
+    assert list(xs) == [11.0, 13.0] and list(ys) == [-3.0, -1.0]
+    assert struct.unpack_from('>2d', newWkb, 9+5) == (11.0, -3.0)
+    assert struct.unpack_from('<2d', newWkb, 9+21+5) == (13.0, -1.0)
+
+    # Empty points stay empty, M values and SRID are kept
+    newWkb, xs, _, _ = vectorbendercli.mapWkb(translation(), EMPTY_POINT)
+    assert len(xs) == 0 and all(math.isnan(v) for v in struct.unpack_from('<2d', newWkb, 5))
+    newWkb, _, _, _ = vectorbendercli.mapWkb(translation(), LINESTRING_M)
+    assert newWkb[:13] == LINESTRING_M[:13]
+    assert struct.unpack_from('<6d', newWkb, 13) == (11,-3,100, 13,-1,200)
+
+def testWkbFiles(tmp_path):
+    pairs = writePairs(tmp_path/"pairs.geojson", [(0, 0, 10, -5)])
+    (tmp_path/"in.wkb").write_bytes( POLYGON_Z+MULTIPOINT )
+    (tmp_path/"in.hex").write_text( POLYGON_Z.hex()+"\n"+MULTIPOINT.hex()+"\n" )
+
+    assert vectorbendercli.main([pairs, str(tmp_path/"in.wkb"), str(tmp_path/"out.wkb")]) == 0
+    assert vectorbendercli.main([pairs, str(tmp_path/"in.hex"), str(tmp_path/"out.hex")]) == 0
+
+    expected = [vectorbendercli.mapWkb(translation(), wkb)[0] for wkb in (POLYGON_Z, MULTIPOINT)]
+    assert list(vectorbendercli.readWkbGeometries(str(tmp_path/"out.wkb"))) == expected
+    assert list(vectorbendercli.readWkbGeometries(str(tmp_path/"out.hex"))) == expected
+
+def testGeoJson(tmp_path):
+    pairs = writePairs(tmp_path/"pairs.geojson", [(0, 0, 10, -5)])
+    feature = {"type": "Feature", "bbox": [0, 0, 1, 1], "properties": {"name": "a"}, "geometry": {"type": "GeometryCollection", "geometries": [
+        {"type": "Point", "coordinates": [1, 2, 3]},
+        {"type": "MultiLineString", "coordinates": [[[0, 0], [1, 1]]]},
+    ]}}
+    (tmp_path/"in.geojson").write_text( json.dumps({"type": "FeatureCollection", "features": [feature]}) )
+    (tmp_path/"in.geojsonl").write_text( json.dumps(feature)+"\n\x1e"+json.dumps(feature)+"\n" )
+
+    assert vectorbendercli.main([pairs, str(tmp_path/"in.geojson"), str(tmp_path/"out.geojson")]) == 0
+    assert vectorbendercli.main([pairs, str(tmp_path/"in.geojsonl"), str(tmp_path/"out.geojsonl")]) == 0
+
+    outputs = json.loads((tmp_path/"out.geojson").read_text())["features"]
+    outputs += [json.loads(line) for line in (tmp_path/"out.geojsonl").read_text().splitlines()]
+    assert len(outputs) == 3
+    for output in outputs:
+        assert "bbox" not in output and output["properties"] == {"name": "a"}
+        point, lines = output["geometry"]["geometries"]
+        assert point["coordinates"] == [11, -3, 3]
+        assert lines["coordinates"] == [[[10, -5], [11, -4]]]
+
+def geoPackageGeometry(wkb, envelope=True):
+    flags = 0x01 | (0x02 if envelope else 0)
+    header = b'GP'+bytes([0, flags])+struct.pack('<i', 2056)
+    if envelope:
+        xs, ys = vectorbendercli.wkbCoordinates(wkb)
+        header += struct.pack('<4d', xs.min(), xs.max(), ys.min(), ys.max())
+    return header+wkb
+
+def createGeoPackage(path, rows):
+    connection = sqlite3.connect(str(path))
+    connection.execute("CREATE TABLE gpkg_contents (table_name TEXT, min_x DOUBLE, max_x DOUBLE, min_y DOUBLE, max_y DOUBLE)")
+    connection.execute("CREATE TABLE gpkg_geometry_columns (table_name TEXT, column_name TEXT)")
+    connection.execute("INSERT INTO gpkg_contents VALUES ('parcels', 0, 0, 0, 0)")
+    connection.execute("INSERT INTO gpkg_geometry_columns VALUES ('parcels', 'geom')")
+    connection.execute("CREATE TABLE parcels (fid INTEGER PRIMARY KEY, geom BLOB, name TEXT)")
+    # Simplified spatial index trigger, using the same functions as the GeoPackage rtree triggers
+    connection.execute("CREATE TABLE rtree_parcels_geom (id INTEGER, minx, maxx, miny, maxy)")
+    connection.execute("""CREATE TRIGGER rtree_parcels_geom_update AFTER UPDATE OF geom ON parcels WHEN NOT ST_IsEmpty(NEW.geom)
+        BEGIN INSERT INTO rtree_parcels_geom VALUES (NEW.fid, ST_MinX(NEW.geom), ST_MaxX(NEW.geom), ST_MinY(NEW.geom), ST_MaxY(NEW.geom)); END""")
+    connection.executemany("INSERT INTO parcels (geom, name) VALUES (?, ?)", rows)
+    connection.commit()
+    connection.close()
+
+def testGeoPackage(tmp_path):
+    pairs = writePairs(tmp_path/"pairs.geojson", [(0, 0, 10, -5)])
+    createGeoPackage(tmp_path/"in.gpkg", [
+        (geoPackageGeometry(POLYGON_Z), "a"),
+        (geoPackageGeometry(MULTIPOINT, envelope=False), "b"),
+        (None, "c"),
+    ])
+
+    assert vectorbendercli.main([pairs, str(tmp_path/"in.gpkg"), str(tmp_path/"out.gpkg")]) == 0
+
+    connection = sqlite3.connect(str(tmp_path/"out.gpkg"))
+    rows = connection.execute("SELECT geom, name FROM parcels ORDER BY fid").fetchall()
+    assert [name for _, name in rows] == ["a", "b", "c"] and rows[2][0] is None
+
+    # The envelope is updated, and the header is kept
+    polygon = rows[0][0]
+    assert polygon[:8] == geoPackageGeometry(POLYGON_Z)[:8]
+    assert struct.unpack_from('<4d', polygon, 8) == (10, 20, -5, 5)
+    assert polygon[40:] == vectorbendercli.mapWkb(translation(), POLYGON_Z)[0]
+    assert rows[1][0][8:] == vectorbendercli.mapWkb(translation(), MULTIPOINT)[0]
+
+    assert connection.execute("SELECT min_x, max_x, min_y, max_y FROM gpkg_contents").fetchone() == (10, 20, -5, 5)
+    assert connection.execute("SELECT * FROM rtree_parcels_geom ORDER BY id").fetchall() == [(1, 10, 20, -5, 5), (2, 11, 13, -3, -1)]
+    connection.close()
+
+    # The input isn't changed
+    connection = sqlite3.connect(str(tmp_path/"in.gpkg"))
+    assert connection.execute("SELECT geom FROM parcels WHERE fid = 1").fetchone()[0] == geoPackageGeometry(POLYGON_Z)
+    connection.close()
+
+def testPairsAreReadFromAnyFormat(tmp_path):
+    lines = struct.pack('<BII', 1, 2, 3)+struct.pack('<6d', 0,0, 5,5, 1,2)
+    (tmp_path/"pairs.wkb").write_bytes( lines )
+    ax, ay, bx, by = vectorbendercli.readPairs(str(tmp_path/"pairs.wkb"))
+    assert (list(ax), list(ay), list(bx), list(by)) == ([0], [0], [1], [2])
+
+    # Empty lines are skipped
+    empty = struct.pack('<BII', 1, 2, 0)
+    (tmp_path/"pairs.hex").write_text( empty.hex()+"\n"+lines.hex()+"\n" )
+    ax, ay, bx, by = vectorbendercli.readPairs(str(tmp_path/"pairs.hex"))
+    assert (list(ax), list(ay), list(bx), list(by)) == ([0], [0], [1], [2])
+    createGeoPackage(tmp_path/"pairs.gpkg", [(geoPackageGeometry(empty, envelope=False), "empty"), (geoPackageGeometry(lines), "a")])
+    ax, ay, bx, by = vectorbendercli.readPairs(str(tmp_path/"pairs.gpkg"))
+    assert (list(ax), list(ay), list(bx), list(by)) == ([0], [0], [1], [2])
+
+def testErrorExitCodes(tmp_path, capsys):
+    pairs = writePairs(tmp_path/"pairs.geojson", [(0, 0, 10, -5)])
+    (tmp_path/"in.geojson").write_text( json.dumps({"type": "FeatureCollection", "features": []}) )
+    (tmp_path/"in.shp").write_bytes( b'' )
+    noPairs = writePairs(tmp_path/"nopairs.geojson", [])
+
+    # Missing file, unsupported format, no pairs
+    assert vectorbendercli.main([pairs, str(tmp_path/"missing.geojson"), str(tmp_path/"out.geojson")]) == 1
+    assert vectorbendercli.main([pairs, str(tmp_path/"in.shp"), str(tmp_path/"out.shp")]) == 1
+    assert vectorbendercli.main([noPairs, str(tmp_path/"in.geojson"), str(tmp_path/"out.geojson")]) == 1
+    assert "vectorbender:" in capsys.readouterr().err
+
+    # Pairs that can't be triangulated
+    collinear = writePairs(tmp_path/"collinear.geojson", [(i, i, i+1, i) for i in range(5)])
+    assert vectorbendercli.main([collinear, str(tmp_path/"in.geojson"), str(tmp_path/"out.geojson")]) == 1
+    assert "vectorbender:" in capsys.readouterr().err
+
+    # Invalid arguments
+    with pytest.raises(SystemExit) as e:
+        vectorbendercli.main([pairs, str(tmp_path/"in.geojson")])
+    assert e.value.code == 2
+
+    assert vectorbendercli.main([pairs, str(tmp_path/"in.geojson"), str(tmp_path/"out.geojson")]) == 0
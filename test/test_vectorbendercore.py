@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+import numpy
+import pytest
+
+from vectorbendercore import *
+
+
+def randomPairs(count, seed=0, size=100.0, noise=1.0):
+    rng = numpy.random.default_rng(seed)
+    ax, ay = rng.uniform(0, size, count), rng.uniform(0, size, count)
+    return ax, ay, ax+rng.normal(0, noise, count), ay+rng.normal(0, noise, count)
+
+def smoothPairs(count, seed=0, size=1000.0):
+    rng = numpy.random.default_rng(seed)
+    ax, ay = rng.uniform(0, size, count), rng.uniform(0, size, count)
+    return ax, ay, ax+5*numpy.sin(ax/150), ay+5*numpy.cos(ay/200)
+
+def models():
+    ax, ay, bx, by = randomPairs(3)
+    yield TranslationModel(ax[:1], ay[:1], bx[:1], by[:1])
+    yield LinearModel(ax[:2], ay[:2], bx[:2], by[:2])
+    yield AffineModel(ax, ay, bx, by)
+    pytest.importorskip("matplotlib")
+    ax, ay, bx, by = randomPairs(50)
+    yield BendModel(ax, ay, bx, by, 0)
+    yield BendModel(ax, ay, bx, by, 20)
+    yield TiledBendModel(ax, ay, bx, by, 20, 30)
+
+
+def testMapPointMatchesMapArrays():
+    rng = numpy.random.default_rng(1)
+    xs, ys = rng.uniform(-50, 150, 200), rng.uniform(-50, 150, 200)
+    for model in models():
+        mx, my = model.mapArrays(xs, ys)
+        points = [model.mapPoint(x, y) for x, y in zip(xs, ys)]
+        assert numpy.allclose(mx, [p[0] for p in points], rtol=0, atol=1e-9), type(model).__name__
+        assert numpy.allclose(my, [p[1] for p in points], rtol=0, atol=1e-9), type(model).__name__
+
+def testPairsMapOntoTargets():
+    for count in (1, 2, 3):
+        ax, ay, bx, by = randomPairs(count)
+        mx, my = createModel(ax, ay, bx, by).mapArrays(ax, ay)
+        assert numpy.allclose(mx, bx) and numpy.allclose(my, by)
+
+    pytest.importorskip("matplotlib")
+    ax, ay, bx, by = randomPairs(100)
+    for model in (BendModel(ax, ay, bx, by, 10), BendModel(ax, ay, bx, by, 0)):
+        mx, my = model.mapArrays(ax, ay)
+        assert numpy.allclose(mx, bx, rtol=0, atol=1e-9) and numpy.allclose(my, by, rtol=0, atol=1e-9)
+
+def testOutsideOfTheMeshIsUnchanged():
+    pytest.importorskip("matplotlib")
+    ax, ay, bx, by = randomPairs(50)
+    for model in (BendModel(ax, ay, bx, by, 10), TiledBendModel(ax, ay, bx, by, 10, 30)):
+        mx, my = model.mapArrays([-500.0, 500.0], [0.0, 1000.0])
+        assert list(mx) == [-500.0, 500.0] and list(my) == [0.0, 1000.0]
+
+def testCreateModel():
+    ax, ay, bx, by = randomPairs(4)
+    assert isinstance(createModel(ax[:1], ay[:1], bx[:1], by[:1]), TranslationModel)
+    assert isinstance(createModel(ax[:2], ay[:2], bx[:2], by[:2]), LinearModel)
+    assert isinstance(createModel(ax[:3], ay[:3], bx[:3], by[:3]), AffineModel)
+    with pytest.raises(ValueError):
+        createModel(ax[:0], ay[:0], bx[:0], by[:0])
+
+    pytest.importorskip("matplotlib")
+    assert isinstance(createModel(ax, ay, bx, by), BendModel)
+    tiled = createModel(ax, ay, bx, by, 10, 30, 8)
+    assert isinstance(tiled, TiledBendModel) and tiled.maxTiles == 8
+
+def testTiledBendingIsContinuousAcrossTiles():
+    pytest.importorskip("matplotlib")
+    ax, ay, bx, by = smoothPairs(2000)
+    model = TiledBendModel(ax, ay, bx, by, 50, 200)
+
+    # Points on both sides of the tiles borders and of the blending bands borders
+    eps = 1e-7
+    borders = [model.xMin+i*model.tileSize+offset for i in range(1, 4) for offset in (0, -model.margin, model.margin)]
+    ys = numpy.linspace(100, 900, 50)
+    for x in borders:
+        before = model.mapArrays(numpy.full(len(ys), x-eps), ys)
+        after = model.mapArrays(numpy.full(len(ys), x+eps), ys)
+        assert numpy.abs(after[0]-before[0]).max() < 1e-4
+        assert numpy.abs(after[1]-before[1]).max() < 1e-4
+
+def testTiledBendingWithFewCachedTiles():
+    pytest.importorskip("matplotlib")
+    ax, ay, bx, by = smoothPairs(2000)
+    xs, ys = numpy.random.default_rng(2).uniform(0, 1000, (2, 300))
+    expected = TiledBendModel(ax, ay, bx, by, 50, 200).mapArrays(xs, ys)
+    model = TiledBendModel(ax, ay, bx, by, 50, 200, maxTiles=2)
+    mx, my = model.mapArrays(xs, ys)
+    assert numpy.allclose(mx, expected[0], rtol=0, atol=1e-9) and numpy.allclose(my, expected[1], rtol=0, atol=1e-9)
+    assert len(model.tiles) <= 2
+
+def testSharedVerticesStayCoincident():
+    # Vertices shared by adjacent features are mapped to the same coordinates, whichever batch or tile group they're in
+    pytest.importorskip("matplotlib")
+    ax, ay, bx, by = smoothPairs(2000)
+    xs, ys = numpy.random.default_rng(4).uniform(0, 1000, (2, 200))
+    for model in (BendModel(ax, ay, bx, by, 50), TiledBendModel(ax, ay, bx, by, 50, 200)):
+        mx, my = model.mapArrays(numpy.concatenate((xs, xs[::-1])), numpy.concatenate((ys, ys[::-1])))
+        assert (mx[:200] == mx[200:][::-1]).all() and (my[:200] == my[200:][::-1]).all()
+        sx, sy = model.mapArrays(xs[:10], ys[:10])
+        assert (sx == mx[:10]).all() and (sy == my[:10]).all()
+
+def testDisplacementGrid():
+    pytest.importorskip("matplotlib")
+    ax, ay, bx, by = smoothPairs(200)
+    model = BendModel(ax, ay, bx, by, 50)
+    grid = DisplacementGrid(model, 0, 0, 1000, 1000, 10)
+    try:
+        assert (grid.cols, grid.rows) == (101, 101)
+
+        # Nodes are exact, and the error at the cells centres (where it is measured) is at most the estimate
+        nodesX, nodesY = numpy.meshgrid(numpy.arange(0, 1001, 10.0), numpy.arange(0, 1001, 10.0))
+        mx, my, inside = grid.mapArrays(nodesX.ravel(), nodesY.ravel())
+        exact = model.mapArrays(nodesX.ravel(), nodesY.ravel())
+        assert inside.all()
+        assert numpy.allclose(mx, exact[0], rtol=0, atol=1e-9) and numpy.allclose(my, exact[1], rtol=0, atol=1e-9)
+        mx, my, inside = grid.mapArrays(nodesX.ravel()[:-1]+5, nodesY.ravel()[:-1]+5)
+        exact = model.mapArrays(nodesX.ravel()[:-1]+5, nodesY.ravel()[:-1]+5)
+        assert numpy.hypot(mx-exact[0], my-exact[1])[inside].max() <= grid.estimatedError+1e-9
+        assert grid.estimatedError > 0
+
+        xs, ys = numpy.random.default_rng(3).uniform(0, 1000, (2, 500))
+        mx, my, inside = grid.mapArrays(xs, ys)
+        assert inside.all()
+
+        assert grid.mapPoint(-100.0, 500.0) is None
+        assert grid.mapPoint(xs[0], ys[0]) == pytest.approx((mx[0], my[0]))
+
+        # Outside of the grid, the grid model falls back to the model
+        gridModel = GridModel(model, grid)
+        assert gridModel.mapPoint(-100.0, 500.0) == model.mapPoint(-100.0, 500.0)
+        mx, my = gridModel.mapArrays([-100.0, xs[0]], [500.0, ys[0]])
+        assert (mx[0], my[0]) == pytest.approx(model.mapPoint(-100.0, 500.0))
+        assert (mx[1], my[1]) == pytest.approx(grid.mapPoint(xs[0], ys[0]))
+    finally:
+        grid.close()
+
+def testDisplacementGridBuildsTilesOnce():
+    pytest.importorskip("matplotlib")
+
+    class CountingModel(TiledBendModel):
+        builds = 0
+        def tile(self, col, row):
+            if (col, row) not in self.tiles:
+                self.builds += 1
+            return TiledBendModel.tile(self, col, row)
+
+    ax, ay, bx, by = smoothPairs(2000)
+    model = CountingModel(ax, ay, bx, by, 20, 50, maxTiles=16)
+    grid = DisplacementGrid(model, 0, 0, 1000, 1000, 5)
+    try:
+        # The grid needs the 22x22 tiles of the extent and of the buffer (a row by row sampling needed each tile for
+        # many rows, building them again and again with few cached tiles)
+        assert model.builds <= 1.5*22*22
+
+        # Same field as sampled at once
+        xs, ys = numpy.meshgrid(numpy.arange(0, 1001, 5.0), numpy.arange(1000, -1, -5.0))
+        mx, my = TiledBendModel(ax, ay, bx, by, 20, 50).mapArrays(xs.ravel(), ys.ravel())
+        assert numpy.allclose(grid.field[0].ravel(), mx-xs.ravel(), rtol=0, atol=1e-9)
+        assert numpy.allclose(grid.field[1].ravel(), my-ys.ravel(), rtol=0, atol=1e-9)
+    finally:
+        grid.close()
+
+def testDisplacementGridSize():
+    assert DisplacementGrid.size(0, 0, 1000, 500, 10) == (101, 51)
+    assert DisplacementGrid.size(0, 0, 0, 0, 10) == (2, 2)
+    assert DisplacementGrid.fileSize(101, 51) == 16*101*51
+    # Ranges follow the groups, share their end node, and are split at maxLength
+    assert DisplacementGrid.ranges(numpy.array([0, 0, 0, 1, 1, 2]), 10) == [(0, 3), (3, 5)]
+    assert DisplacementGrid.ranges(numpy.zeros(6), 2) == [(0, 2), (2, 4), (4, 5)]
+
+def testConvexHull():
+    xs = numpy.array([0.0, 1.0, 1.0, 0.0, 0.5, 0.2])
+    ys = numpy.array([0.0, 0.0, 1.0, 1.0, 0.5, 0.7])
+    hx, hy = convexHull(xs, ys)
+    assert sorted(zip(hx.tolist(), hy.tolist())) == [(0.0, 0.0), (0.0, 1.0), (1.0, 0.0), (1.0, 1.0)]
+    # Counter clockwise
+    assert numpy.sum(hx*numpy.roll(hy, -1)-numpy.roll(hx, -1)*hy) > 0
@@ -31,6 +31,9 @@ from qgis.gui import *
 import os.path
 import sys
 import math
+import queue
+import threading
+import concurrent.futures
 
 # More tricky dependencies
 from distutils.version import StrictVersion
@@ -52,6 +55,12 @@ from .vectorbenderhelp import VectorBenderHelp
 
 class VectorBender:
 
+    # Size in bytes of the displacement grid file above which the user is asked to confirm
+    LARGE_GRID_SIZE = 1024**3
+
+    # Number of features mapped at once by the workers (their vertices go through the transformer together)
+    BATCH_SIZE = 500
+
     def __init__(self, iface):
         self.iface = iface
         self.dlg = VectorBenderDialog(iface,self)
@@ -83,6 +92,7 @@ class VectorBender:
 
     def unload(self):
         if self.dlg is not None:
+            self.dlg.disconnectSignals()
             self.dlg.close()
             self.dlg = None
 
@@ -107,13 +117,12 @@ class VectorBender:
             3 if three pairs found => affine
             4 if four or more pairs found => bending"""
 
-        pairsLayer = self.dlg.pairsLayer()
+        featuresCount = self.dlg.pairsCount()
 
-        if pairsLayer is None:
+        if featuresCount is None:
+            # Still being counted
             return 0
 
-        featuresCount = len(pairsLayer.selectedFeatureIds()) if self.dlg.restrictBox_pairsLayer.isChecked() else len(pairsLayer.allFeatureIds())
-
         if featuresCount == 1:
             return 1
         elif featuresCount == 2:
@@ -128,123 +137,222 @@ class VectorBender:
 
         return 0
 
-    def run(self):
-
-        self.dlg.progressBar.setValue( 0 )
+    def createTransformer(self):
+        """Returns the transformer matching the current transformation type, or None if it is invalid"""
 
-        toBendLayer = self.dlg.toBendLayer()
         pairsLayer = self.dlg.pairsLayer()
 
         transType = self.determineTransformationType()
 
         # Loading the delaunay
         restrictToSelection = self.dlg.restrictBox_pairsLayer.isChecked()
-        if transType==4:
+        if transType==4 and self.dlg.tileSizeValue()>0:
+            self.dlg.displayMsg( "Partitioning pairs in tiles of size %f ..." % self.dlg.tileSizeValue() )
+            QCoreApplication.processEvents()
+            return TiledBendTransformer( pairsLayer, restrictToSelection, self.dlg.bufferValue(), self.dlg.tileSizeValue(), self.dlg.maxTilesValue() )
+        elif transType==4:
             self.dlg.displayMsg( "Loading delaunay mesh (%i points) ..." % len(self.ptsA) )
             QCoreApplication.processEvents()
-            self.transformer = BendTransformer( pairsLayer, restrictToSelection, self.dlg.bufferValue() )
+            return BendTransformer( pairsLayer, restrictToSelection, self.dlg.bufferValue() )
         elif transType==3:
             self.dlg.displayMsg( "Loading affine transformation vectors..."  )
-            self.transformer = AffineTransformer( pairsLayer, restrictToSelection )
+            return AffineTransformer( pairsLayer, restrictToSelection )
         elif transType==2:
             self.dlg.displayMsg( "Loading linear transformation vectors..."  )
-            self.transformer = LinearTransformer( pairsLayer, restrictToSelection )
+            return LinearTransformer( pairsLayer, restrictToSelection )
         elif transType==1:
             self.dlg.displayMsg( "Loading translation vector..."  )
-            self.transformer = TranslationTransformer( pairsLayer, restrictToSelection )
+            return TranslationTransformer( pairsLayer, restrictToSelection )
         else:
             self.dlg.displayMsg( "INVALID TRANSFORMATION TYPE - YOU SHOULDN'T HAVE BEEN ABLE TO HIT RUN" )
-            return
-
-        # Starting to iterate
-        features = toBendLayer.getFeatures() if not self.dlg.restrictBox_toBendLayer.isChecked() else toBendLayer.selectedFeatures()
-
-        count = toBendLayer.featureCount() if not self.dlg.restrictBox_toBendLayer.isChecked() else len(features)
-        self.dlg.displayMsg( "Starting to iterate through %i features..." % count )
+            return None
+
+    def createGrid(self, transformer, toBendLayers):
+        """Samples the displacement field of the transformer over the extent of the layers to bend, returns None if the user cancels a very large grid"""
+
+        # The grid is in the CRS of the pairs
+        pairsCrs = self.dlg.pairsLayer().crs()
+        extent = QgsRectangle()
+        extent.setMinimal()
+        for toBendLayer in toBendLayers:
+            layerExtent = toBendLayer.extent() if not self.dlg.restrictBox_toBendLayer.isChecked() else toBendLayer.boundingBoxOfSelected()
+            if toBendLayer.crs() != pairsCrs:
+                layerExtent = QgsCoordinateTransform(toBendLayer.crs(), pairsCrs, QgsProject.instance().transformContext()).transformBoundingBox(layerExtent)
+            extent.combineExtentWith( layerExtent )
+
+        # Fine resolutions over large extents quickly need huge files, so we ask before
+        cols, rows = DisplacementGrid.size( extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(), self.dlg.gridResolutionValue() )
+        fileSize = DisplacementGrid.fileSize(cols, rows)
+        if fileSize > self.LARGE_GRID_SIZE:
+            retval = QMessageBox.question(self.dlg, "Displacement grid", "The displacement grid will have %i x %i nodes, and needs a temporary file of %.1f GB. Do you want to continue ?\nYou can increase the resolution to get a smaller grid." % (cols, rows, fileSize/1024.0**3), QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+            if retval != QMessageBox.Yes:
+                self.dlg.displayMsg( "Displacement grid cancelled, increase the resolution to get a smaller grid." )
+                return None
+
+        self.dlg.displayMsg( "Sampling displacement grid (resolution %f) ..." % self.dlg.gridResolutionValue() )
+        QCoreApplication.processEvents()
+        return DisplacementGrid( transformer.model, extent.xMinimum(), extent.yMinimum(), extent.xMaximum(), extent.yMaximum(), self.dlg.gridResolutionValue() )
+
+    def layerTransformer(self, transformer, toBendLayer, pairsLayer):
+        """Returns the transformer to use for a layer : the given one, wrapped to reproject the vertices to the CRS of the pairs and back if the layer is in another CRS"""
+        if transformer is None or toBendLayer.crs() == pairsLayer.crs():
+            return transformer
+        return ReprojectedTransformer( transformer, toBendLayer.crs(), pairsLayer.crs(), QgsProject.instance().transformContext() )
+
+    def bendFeatures(self, layerIndex, source, request, transformer, results, stop):
+        """Worker for bend() : maps the features of one layer and queues (layerIndex, featureId, newGeom) for the main thread, until stop is set.
+        newGeom is None for features that the transformation doesn't move, which are left out of the edit buffer and undo stack."""
+
+        def put(item):
+            # The queue is bounded, so we wait for room unless the main thread stopped reading it
+            while not stop.is_set():
+                try:
+                    results.put( item, timeout=0.1 )
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def flush(batch):
+            geoms = [feature.geometry() for feature in batch]
+            newGeoms = transformer.mapGeometries( geoms )
+            for feature, geom, newGeom in zip(batch, geoms, newGeoms):
+                if newGeom is geom:
+                    newGeom = None
+                if not put( (layerIndex, feature.id(), newGeom) ):
+                    return False
+            return True
+
+        try:
+            batch = []
+            for feature in source.getFeatures(request):
+                batch.append( feature )
+                if len(batch) >= self.BATCH_SIZE:
+                    if not flush(batch):
+                        return
+                    batch = []
+            if batch and not flush(batch):
+                return
+        except Exception:
+            # Stops the other workers and the main thread, the error is raised from run()
+            stop.set()
+            raise
+        # None marks the end of this layer
+        put( (layerIndex, None, None) )
+
+    def displayProgress(self, i, count):
+        self.dlg.progressBar.setValue( int(100.0*float(i)/float(max(count,1))) )
+        self.dlg.displayMsg( "Aligning features %i out of %i..."  % (i, count))
         QCoreApplication.processEvents()
 
-        toBendLayer.beginEditCommand("Feature bending")
-        for i,feature in enumerate(features):
+    def run(self):
 
-            self.dlg.progressBar.setValue( int(100.0*float(i)/float(count)) )
-            self.dlg.displayMsg( "Aligning features %i out of %i..."  % (i, count))
-            QCoreApplication.processEvents()
+        # The buttons stay disabled for the whole job, since processing the events to show the progress would let them be clicked again
+        self.dlg.setBusy(True)
+        try:
+            self.bend()
+        finally:
+            self.dlg.setBusy(False)
 
-            geom = feature.geometry()
+    def bend(self):
 
-            #TODO : this cood be much simple if we could iterate through to vertices and use QgsGeometry.moveVertex(x,y,index), but QgsGeometry.vertexAt(index) doesn't tell wether the index exists, so there's no clean way to iterate...
+        self.dlg.progressBar.setValue( 0 )
 
-            if geom.type() == QgsWkbTypes.PointGeometry:
+        toBendLayers = self.dlg.toBendLayers()
+        pairsLayer = self.dlg.pairsLayer()
 
-                if not geom.isMultipart():
-                    # SINGLE PART POINT
-                    p = geom.asPoint()
-                    newGeom = QgsGeometry.fromPointXY( self.transformer.map(p) )
+        self.transformer = self.createTransformer()
+        if self.transformer is None:
+            return
 
-                else:
-                    # MULTI PART POINT
-                    listA = geom.asMultiPoint()
-                    newListA = []
-                    for p in listA:
-                        newListA.append( self.transformer.map(p) )
-                    newGeom = QgsGeometry.fromMultiPointXY( newListA )
-
-            elif geom.type() == QgsWkbTypes.LineGeometry:
-
-                if not geom.isMultipart():
-                    # SINGLE PART LINESTRING
-                    listA = geom.asPolyline()
-                    newListA = []
-                    for p in listA:
-                        newListA.append( self.transformer.map(p) )
-                    newGeom = QgsGeometry.fromPolylineXY( newListA )
+        # Grid evaluation mode
+        grid = None
+        if self.dlg.gridModeCheckBox.isChecked():
+            grid = self.createGrid( self.transformer, toBendLayers )
+            if grid is None:
+                return
+            QgsMessageLog.logMessage("Displacement grid of %i x %i nodes, estimated interpolation error %f" % (grid.cols, grid.rows, grid.estimatedError), 'VectorBender')
+            self.transformer = GridTransformer( self.transformer, grid )
 
-                else:
-                    # MULTI PART LINESTRING
-                    listA = geom.asMultiPolyline()
-                    newListA = []
-                    for listB in listA:
-                        newListB = []
-                        for p in listB:
-                            newListB.append( self.transformer.map(p) )
-                        newListA.append( newListB )
-                    newGeom = QgsGeometry.fromMultiPolylineXY( newListA )
-
-            elif geom.type() == QgsWkbTypes.PolygonGeometry:
-
-                if not geom.isMultipart():
-                    # SINGLE PART POLYGON
-                    listA = geom.asPolygon()
-                    newListA = []
-                    for listB in listA:
-                        newListB = []
-                        for p in listB:
-                            newListB.append( self.transformer.map(p) )
-                        newListA.append( newListB )
-                    newGeom = QgsGeometry.fromPolygonXY( newListA )
+        # Layers in another CRS than the pairs are reprojected on the fly while bending
+        for toBendLayer in toBendLayers:
+            if toBendLayer.crs() != pairsLayer.crs():
+                QgsMessageLog.logMessage("Layer %s is in %s and the pairs in %s, its vertices are reprojected to the CRS of the pairs while bending" % (toBendLayer.name(), toBendLayer.crs().authid(), pairsLayer.crs().authid()), 'VectorBender')
 
-                else:
-                    # MULTI PART POLYGON
-                    listA = geom.asMultiPolygon()
-                    newListA = []
-                    for listB in listA:
-                        newListB = []
-                        for listC in listB:
-                            newListC = []
-                            for p in listC:
-                                newListC.append( self.transformer.map(p) )
-                            newListB.append( newListC )
-                        newListA.append( newListB )
-                    newGeom = QgsGeometry.fromMultiPolygonXY( newListA )
+        # Starting to iterate
+        restrictToSelection = self.dlg.restrictBox_toBendLayer.isChecked()
+        count = 0
+        for toBendLayer in toBendLayers:
+            count += toBendLayer.featureCount() if not restrictToSelection else toBendLayer.selectedFeatureCount()
 
-            else:
-                # FALLBACK, JUST IN CASE ;)
-                newGeom = geom
+        self.dlg.displayMsg( "Starting to iterate through %i features of %i layers..." % (count, len(toBendLayers)) )
+        QCoreApplication.processEvents()
 
-            toBendLayer.changeGeometry( feature.id(), newGeom )
+        # Features are read and mapped in worker threads through thread-safe feature sources (one per layer, all sharing
+        # the same transformer), while the geometries are written to the layers from this thread since layer edits aren't thread-safe
+        requests = []
+        for toBendLayer in toBendLayers:
+            request = QgsFeatureRequest()
+            if restrictToSelection:
+                request.setFilterFids( toBendLayer.selectedFeatureIds() )
+            requests.append( request )
+
+        # The queue is bounded so that workers can't get too far ahead of the writing
+        results = queue.Queue(maxsize=1000)
+        workers = max(1, min(len(toBendLayers), QThread.idealThreadCount()))
+
+        for toBendLayer in toBendLayers:
+            toBendLayer.beginEditCommand("Feature bending")
+
+        i = 0
+        remainingLayers = len(toBendLayers)
+        stop = threading.Event()
+        failed = True
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [ executor.submit( self.bendFeatures, layerIndex, QgsVectorLayerFeatureSource(toBendLayer), requests[layerIndex], self.layerTransformer(self.transformer, toBendLayer, pairsLayer), results, stop ) for layerIndex,toBendLayer in enumerate(toBendLayers) ]
+
+                try:
+                    while remainingLayers > 0 and not stop.is_set():
+                        try:
+                            layerIndex, featureId, newGeom = results.get( timeout=0.1 )
+                        except queue.Empty:
+                            continue
+
+                        if featureId is None:
+                            remainingLayers -= 1
+                            continue
+
+                        if newGeom is not None:
+                            toBendLayers[layerIndex].changeGeometry( featureId, newGeom )
+
+                        if i % 100 == 0:
+                            self.displayProgress( i, count )
+                        i += 1
+                finally:
+                    # Unblocks the workers (stopping them if we left early) so that the executor can shut down
+                    stop.set()
+                    while True:
+                        try:
+                            results.get_nowait()
+                        except queue.Empty:
+                            break
+
+            # Raise the errors of the workers, if any
+            for future in futures:
+                future.result()
+            failed = False
+        finally:
+            # A partial bend is dropped instead of being kept as a "Feature bending" command
+            for toBendLayer in toBendLayers:
+                if failed:
+                    toBendLayer.destroyEditCommand()
+                else:
+                    toBendLayer.endEditCommand()
+                toBendLayer.repaintRequested.emit()
 
-        toBendLayer.endEditCommand()
-        toBendLayer.repaintRequested.emit()
+            if grid is not None:
+                grid.close()
 
 
         #Transforming pairs to pins
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+"""
+Command line entry point of VectorBender, bending files without QGIS :
+
+    python -m VectorBender.vectorbendercli pairs.geojson input.gpkg output.gpkg --buffer 25
+
+The pairs file contains lines, from the original location (first point) to the target location (last point), and
+the transformation type is chosen from the number of pairs like in the plugin. Supported formats (by extension) :
+    - .gpkg : GeoPackage, every feature table is bent in a copy of the file, by batches of rows
+    - .geojson, .json : GeoJSON (the whole file is loaded)
+    - .geojsonl, .geojsons, .ndjson : GeoJSON sequences, one feature per line, streamed
+    - .wkb : concatenated binary WKB geometries, streamed
+    - .hex : hex encoded WKB geometries, one per line, streamed
+
+This only needs numpy and matplotlib, so that jobs start fast and can be run in parallel from batch pipelines.
+"""
+import sys
+import json
+import mmap
+import shutil
+import sqlite3
+import struct
+import argparse
+import binascii
+
+import numpy
+
+try:
+    from .vectorbendercore import *
+except ImportError:
+    # Run as a script rather than as a module of the plugin package
+    from vectorbendercore import *
+
+
+# WKB geometry types whose body is a list of points, a list of rings, or a list of geometries
+WKB_POINTS_TYPES = (2, 8)                            # LineString, CircularString
+WKB_RINGS_TYPES = (3, 17)                            # Polygon, Triangle
+WKB_COLLECTION_TYPES = (4, 5, 6, 7, 9, 10, 11, 12, 15, 16)
+
+GEOJSON_SEQUENCE_EXTENSIONS = ('.geojsonl', '.geojsons', '.ndjson')
+
+def wkbRuns(wkb, offset, runs):
+    """
+    Parses the WKB geometry starting at offset, appends (start, count, stride, littleEndian) for each run of
+    contiguous points (start being the offset of the x of the first point) to runs, and returns the end offset
+    """
+    littleEndian = wkb[offset] == 1
+    order = '<' if littleEndian else '>'
+    wkbType = struct.unpack_from(order+'I', wkb, offset+1)[0]
+    offset += 5
+
+    # EWKB flags, or ISO type codes
+    dims = 2 + (1 if wkbType & 0x80000000 else 0) + (1 if wkbType & 0x40000000 else 0)
+    if wkbType & 0x20000000:
+        offset += 4 # SRID
+    wkbType &= 0x0FFFFFFF
+    dims += {0:0, 1:1, 2:1, 3:2}[wkbType // 1000]
+    baseType = wkbType % 1000
+    stride = 8*dims
+
+    if baseType == 1:
+        runs.append( (offset, 1, stride, littleEndian) )
+        return offset+stride
+    elif baseType in WKB_POINTS_TYPES:
+        count = struct.unpack_from(order+'I', wkb, offset)[0]
+        runs.append( (offset+4, count, stride, littleEndian) )
+        return offset+4+count*stride
+    elif baseType in WKB_RINGS_TYPES:
+        rings = struct.unpack_from(order+'I', wkb, offset)[0]
+        offset += 4
+        for i in range(rings):
+            count = struct.unpack_from(order+'I', wkb, offset)[0]
+            runs.append( (offset+4, count, stride, littleEndian) )
+            offset += 4+count*stride
+        return offset
+    elif baseType in WKB_COLLECTION_TYPES:
+        parts = struct.unpack_from(order+'I', wkb, offset)[0]
+        offset += 4
+        for i in range(parts):
+            offset = wkbRuns(wkb, offset, runs)
+        return offset
+
+    raise ValueError("Unsupported WKB geometry type %i" % wkbType)
+
+def mapWkb(model, wkb, offset=0):
+    """
+    Returns (newWkb, xs, ys, end) : a copy of the WKB geometry starting at offset with all its vertices mapped by the
+    model, the mapped coordinates and the end offset of the geometry. Z and M values are kept.
+    """
+    runs = []
+    end = wkbRuns(wkb, offset, runs)
+
+    buf = bytearray(wkb[offset:end])
+    data = numpy.frombuffer(buf, dtype=numpy.uint8)
+    runs = [run for run in runs if run[1] > 0]
+    if not runs:
+        return bytes(buf), numpy.zeros(0), numpy.zeros(0), end
+
+    # Bytes of the x and y of every point (in vertex order), read and written back at once
+    starts = numpy.concatenate([ start-offset+numpy.arange(count)*stride for start, count, stride, _ in runs ])
+    littleEndian = numpy.concatenate([ numpy.full(count, little) for _, count, _, little in runs ])
+    indexes = starts[:,None]+numpy.arange(16)
+
+    xy = numpy.empty((len(starts),2))
+    for little, dtype in ((True, numpy.dtype('<f8')), (False, numpy.dtype('>f8'))):
+        if numpy.any(littleEndian == little):
+            xy[littleEndian == little] = data[indexes[littleEndian == little]].view(dtype)
+
+    # Empty points are NaN
+    valid = numpy.isfinite(xy).all(axis=1)
+    mx, my = model.mapArrays(xy[valid,0], xy[valid,1])
+    xy[valid,0] = mx
+    xy[valid,1] = my
+
+    for little, dtype in ((True, numpy.dtype('<f8')), (False, numpy.dtype('>f8'))):
+        if numpy.any(littleEndian == little):
+            data[indexes[littleEndian == little]] = xy[littleEndian == little].astype(dtype).view(numpy.uint8)
+
+    return bytes(buf), numpy.asarray(mx, dtype=float), numpy.asarray(my, dtype=float), end
+
+def wkbCoordinates(wkb):
+    """ Returns the x and y arrays of the vertices of the WKB geometry """
+    _, xs, ys, _ = mapWkb(Model(), wkb)
+    return xs, ys
+
+
+# GeoPackage
+
+def geoPackageHeaderSize(blob):
+    """ Returns the size of the GeoPackage geometry header (which is followed by the WKB geometry) """
+    if blob[0:2] != b'GP':
+        raise ValueError("Invalid GeoPackage geometry")
+    if blob[3] & 0x20:
+        raise ValueError("Extended GeoPackage geometries are not supported")
+    return 8+{0:0, 1:32, 2:48, 3:48, 4:64}[(blob[3]>>1) & 7]
+
+def isGeoPackageEmpty(blob):
+    return blob is None or bool(blob[3] & 0x10)
+
+def mapGeoPackageGeometry(model, blob):
+    """ Returns (newBlob, xs, ys) : a copy of the GeoPackage geometry with all its vertices mapped, and its envelope updated """
+    blob = bytes(blob)
+    headerSize = geoPackageHeaderSize(blob)
+    if isGeoPackageEmpty(blob):
+        return blob, numpy.zeros(0), numpy.zeros(0)
+
+    wkb, xs, ys, _ = mapWkb(model, blob, headerSize)
+
+    header = bytearray(blob[:headerSize])
+    if headerSize > 8 and len(xs):
+        order = '<' if blob[3] & 1 else '>'
+        struct.pack_into(order+'4d', header, 8, xs.min(), xs.max(), ys.min(), ys.max())
+
+    return bytes(header)+wkb, xs, ys
+
+def geoPackageEnvelope(blob):
+    """ Returns the (minX, maxX, minY, maxY) envelope of the GeoPackage geometry, or None if it's empty """
+    if isGeoPackageEmpty(blob):
+        return None
+    blob = bytes(blob)
+    headerSize = geoPackageHeaderSize(blob)
+    if headerSize > 8:
+        return struct.unpack_from(('<' if blob[3] & 1 else '>')+'4d', blob, 8)
+    xs, ys = wkbCoordinates(blob[headerSize:])
+    if not len(xs):
+        return None
+    return xs.min(), xs.max(), ys.min(), ys.max()
+
+def registerGeoPackageFunctions(connection):
+    """ Registers the SQL functions used by the GeoPackage rtree triggers, which plain sqlite doesn't have """
+    def envelopeFunction(i):
+        def function(blob):
+            envelope = geoPackageEnvelope(blob)
+            return None if envelope is None else envelope[i]
+        return function
+    connection.create_function("ST_MinX", 1, envelopeFunction(0))
+    connection.create_function("ST_MaxX", 1, envelopeFunction(1))
+    connection.create_function("ST_MinY", 1, envelopeFunction(2))
+    connection.create_function("ST_MaxY", 1, envelopeFunction(3))
+    connection.create_function("ST_IsEmpty", 1, lambda blob: int(geoPackageEnvelope(blob) is None))
+
+def readGeoPackageGeometries(path):
+    """ Yields the WKB geometries of all the feature tables """
+    connection = sqlite3.connect(path)
+    for table, column in connection.execute("SELECT table_name, column_name FROM gpkg_geometry_columns").fetchall():
+        for (blob,) in connection.execute('SELECT "%s" FROM "%s"' % (column, table)):
+            if not isGeoPackageEmpty(blob):
+                yield bytes(blob)[geoPackageHeaderSize(blob):]
+    connection.close()
+
+def bendGeoPackage(model, inputPath, outputPath, batchSize=1000):
+    """ Bends all the feature tables of a copy of the GeoPackage, returns the number of bent features """
+    shutil.copyfile(inputPath, outputPath)
+    connection = sqlite3.connect(outputPath)
+    registerGeoPackageFunctions(connection)
+
+    count = 0
+    for table, column in connection.execute("SELECT table_name, column_name FROM gpkg_geometry_columns").fetchall():
+        extent = [numpy.inf, -numpy.inf, numpy.inf, -numpy.inf]
+        lastRowId = None
+        while True:
+            if lastRowId is None:
+                rows = connection.execute('SELECT rowid, "%s" FROM "%s" ORDER BY rowid LIMIT ?' % (column, table), (batchSize,)).fetchall()
+            else:
+                rows = connection.execute('SELECT rowid, "%s" FROM "%s" WHERE rowid > ? ORDER BY rowid LIMIT ?' % (column, table), (lastRowId, batchSize)).fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for rowId, blob in rows:
+                if blob is None:
+                    continue
+                newBlob, xs, ys = mapGeoPackageGeometry(model, blob)
+                if len(xs):
+                    extent = [min(extent[0], xs.min()), max(extent[1], xs.max()), min(extent[2], ys.min()), max(extent[3], ys.max())]
+                updates.append( (newBlob, rowId) )
+            connection.executemany('UPDATE "%s" SET "%s" = ? WHERE rowid = ?' % (table, column), updates)
+            connection.commit()
+
+            count += len(updates)
+            lastRowId = rows[-1][0]
+
+        if numpy.isfinite(extent[0]):
+            connection.execute("UPDATE gpkg_contents SET min_x = ?, max_x = ?, min_y = ?, max_y = ? WHERE table_name = ?", (float(extent[0]), float(extent[1]), float(extent[2]), float(extent[3]), table))
+            connection.commit()
+
+    connection.close()
+    return count
+
+
+# GeoJSON
+
+def geoJsonPositions(coordinates, positions):
+    """ Appends the positions (lists of coordinates) nested in the GeoJSON coordinates to positions """
+    if len(coordinates) and isinstance(coordinates[0], (int, float)):
+        positions.append( coordinates )
+    else:
+        for c in coordinates:
+            geoJsonPositions(c, positions)
+
+def geoJsonGeometryPositions(geometry, positions):
+    if geometry is None:
+        return
+    if geometry['type'] == 'GeometryCollection':
+        for g in geometry['geometries']:
+            geoJsonGeometryPositions(g, positions)
+    else:
+        geoJsonPositions(geometry['coordinates'], positions)
+
+def mapGeoJsonFeature(model, feature):
+    """ Maps all the vertices of the GeoJSON feature in place """
+    positions = []
+    geoJsonGeometryPositions(feature.get('geometry'), positions)
+    if positions:
+        mx, my = model.mapArrays([p[0] for p in positions], [p[1] for p in positions])
+        for p, x, y in zip(positions, mx.tolist(), my.tolist()):
+            p[0] = x
+            p[1] = y
+    # Bounding boxes would be outdated
+    feature.pop('bbox', None)
+    if feature.get('geometry') is not None:
+        feature['geometry'].pop('bbox', None)
+
+def readGeoJsonFeatures(path):
+    """ Yields the features of a GeoJSON file or GeoJSON sequence """
+    with open(path, 'r') as f:
+        if path.lower().endswith(GEOJSON_SEQUENCE_EXTENSIONS):
+            for line in f:
+                # RFC 8142 sequences start records with a record separator
+                line = line.strip().lstrip('\x1e')
+                if line:
+                    yield json.loads(line)
+        else:
+            data = json.load(f)
+            for feature in (data['features'] if data.get('type') == 'FeatureCollection' else [data]):
+                yield feature
+
+def bendGeoJson(model, inputPath, outputPath):
+    """ Bends the GeoJSON file or GeoJSON sequence, returns the number of bent features """
+    count = 0
+    if inputPath.lower().endswith(GEOJSON_SEQUENCE_EXTENSIONS):
+        with open(outputPath, 'w') as out:
+            for feature in readGeoJsonFeatures(inputPath):
+                mapGeoJsonFeature(model, feature)
+                out.write( json.dumps(feature)+'\n' )
+                count += 1
+    else:
+        with open(inputPath, 'r') as f:
+            data = json.load(f)
+        data.pop('bbox', None)
+        for feature in (data['features'] if data.get('type') == 'FeatureCollection' else [data]):
+            mapGeoJsonFeature(model, feature)
+            count += 1
+        with open(outputPath, 'w') as out:
+            json.dump(data, out)
+    return count
+
+
+# WKB
+
+def readWkbGeometries(path):
+    """ Yields the WKB geometries of a binary (concatenated) or hex (one per line) WKB file """
+    if path.lower().endswith('.hex'):
+        with open(path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield binascii.unhexlify(line)
+    else:
+        with open(path, 'rb') as f:
+            if f.seek(0, 2) == 0:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            offset = 0
+            while offset < len(data):
+                end = wkbRuns(data, offset, [])
+                yield data[offset:end]
+                offset = end
+            data.close()
+
+def bendWkb(model, inputPath, outputPath):
+    """ Bends the binary or hex WKB file, returns the number of bent geometries """
+    count = 0
+    hexFormat = outputPath.lower().endswith('.hex')
+    with open(outputPath, 'w' if hexFormat else 'wb') as out:
+        for wkb in readWkbGeometries(inputPath):
+            newWkb = mapWkb(model, wkb)[0]
+            out.write( binascii.hexlify(newWkb).decode('ascii')+'\n' if hexFormat else newWkb )
+            count += 1
+    return count
+
+
+def readPairs(path):
+    """ Returns the (ax, ay, bx, by) arrays of the first and last points of the lines of the pairs file """
+    pairs = []
+    lower = path.lower()
+    if lower.endswith('.gpkg') or lower.endswith(('.wkb', '.hex')):
+        geometries = readGeoPackageGeometries(path) if lower.endswith('.gpkg') else readWkbGeometries(path)
+        for wkb in geometries:
+            xs, ys = wkbCoordinates(wkb)
+            if len(xs):
+                pairs.append( (xs[0], ys[0], xs[-1], ys[-1]) )
+    else:
+        for feature in readGeoJsonFeatures(path):
+            positions = []
+            geoJsonGeometryPositions(feature.get('geometry'), positions)
+            if positions:
+                pairs.append( (positions[0][0], positions[0][1], positions[-1][0], positions[-1][1]) )
+
+    pairs = numpy.array(pairs, dtype=float).reshape(-1, 4)
+    return pairs[:,0], pairs[:,1], pairs[:,2], pairs[:,3]
+
+def bend(model, inputPath, outputPath):
+    """ Bends the input file to the output file (of the same format), returns the number of bent features """
+    lower = inputPath.lower()
+    if lower.endswith('.gpkg'):
+        return bendGeoPackage(model, inputPath, outputPath)
+    elif lower.endswith(('.wkb', '.hex')):
+        return bendWkb(model, inputPath, outputPath)
+    elif lower.endswith(('.geojson', '.json')+GEOJSON_SEQUENCE_EXTENSIONS):
+        return bendGeoJson(model, inputPath, outputPath)
+    raise ValueError("Unsupported file format : %s" % inputPath)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bends vector files according to pairs of points (rubber sheeting), without QGIS.")
+    parser.add_argument("pairs", help="file of lines from the original location (first point) to the target location (last point)")
+    parser.add_argument("input", help="file to bend (.gpkg, .geojson, .geojsonl, .wkb or .hex)")
+    parser.add_argument("output", help="bent file, in the same format as the input")
+    parser.add_argument("--buffer", type=float, default=0.0, help="buffer around the pairs where the bending smoothly stops (bending only)")
+    parser.add_argument("--tile-size", type=float, default=0.0, help="split very large pairs networks in tiles of this size, each with its own mesh (bending only)")
+    parser.add_argument("--max-tiles", type=int, default=TiledBendModel.MAX_TILES, help="number of tile meshes kept in memory with --tile-size (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    try:
+        ax, ay, bx, by = readPairs(args.pairs)
+        model = createModel(ax, ay, bx, by, args.buffer, args.tile_size, args.max_tiles)
+        count = bend(model, args.input, args.output)
+    except (ValueError, IOError, sqlite3.Error, RuntimeError) as e:
+        # RuntimeError is raised by qhull when the pairs can't be triangulated (for instance collinear pairs without buffer)
+        sys.stderr.write("vectorbender: %s\n" % e)
+        return 1
+
+    sys.stderr.write("vectorbender: %i features bent with %s (%i pairs)\n" % (count, type(model).__name__, len(ax)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
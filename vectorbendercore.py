@@ -0,0 +1,685 @@
+# -*- coding: utf-8 -*-
+"""
+Transformation engine of VectorBender, working on numpy arrays of coordinates.
+
+This module doesn't depend on QGIS so that it can be used (and tested, benchmarked...) from a plain python process,
+see vectorbendercli.py. The QGIS plugin wraps these models in vectorbendertransformers.py.
+
+All models map arrays of coordinates at once with mapArrays(xs, ys), and single points with mapPoint(x, y), which
+avoids the numpy overhead when vertices are mapped one by one.
+"""
+import math
+import os
+import tempfile
+import threading
+import collections
+
+import numpy
+
+try:
+    #we silently fail the import here since message is already taken car in vectorbender.py
+    #(matplotlib is only needed for the bending models)
+    import matplotlib.tri
+except Exception:
+    pass
+
+try:
+    #gdal is only needed to export displacement grids
+    from osgeo import gdal
+except Exception:
+    pass
+
+
+def mapArraysThroughTriangulation(delaunay, trifinder, bx, by, xs, ys):
+    """ Maps arrays of points from the triangulation of the source points to the same triangles on the target points bx, by """
+    xs = numpy.asarray(xs, dtype=float)
+    ys = numpy.asarray(ys, dtype=float)
+
+    triangles = trifinder( xs, ys )
+    found = triangles != -1
+
+    # Points outside of the mesh are not changed
+    mx = xs.copy()
+    my = ys.copy()
+
+    t = delaunay.triangles[triangles[found]]
+    x, y = xs[found], ys[found]
+    x1, y1 = delaunay.x[t[:,0]], delaunay.y[t[:,0]]
+    x2, y2 = delaunay.x[t[:,1]], delaunay.y[t[:,1]]
+    x3, y3 = delaunay.x[t[:,2]], delaunay.y[t[:,2]]
+
+    # Same barycentric formulas as mapPointThroughTriangulation, applied to all points at once
+    det = (y2-y3)*(x1-x3)+(x3-x2)*(y1-y3)
+    l1 = ((y2-y3)*(x-x3)+(x3-x2)*(y-y3))/det
+    l2 = ((y3-y1)*(x-x3)+(x1-x3)*(y-y3))/det
+    l3 = 1-l1-l2
+
+    mx[found] = l1*bx[t[:,0]]+l2*bx[t[:,1]]+l3*bx[t[:,2]]
+    my[found] = l1*by[t[:,0]]+l2*by[t[:,1]]+l3*by[t[:,2]]
+
+    return mx, my
+
+def mapPointThroughTriangulation(delaunay, trifinder, bx, by, x, y):
+    """ Single point version of mapArraysThroughTriangulation, returns a (x, y) tuple """
+    triangle = int(trifinder( x, y ))
+
+    if triangle==-1:
+        # No triangle found : don't change the point
+        return x, y
+
+    # Triangle found : adapt it from the old mesh to the new mesh, through the barycentric coordinates (l1, l2, l3)
+    i1, i2, i3 = delaunay.triangles[triangle]
+    x1, y1 = float(delaunay.x[i1]), float(delaunay.y[i1])
+    x2, y2 = float(delaunay.x[i2]), float(delaunay.y[i2])
+    x3, y3 = float(delaunay.x[i3]), float(delaunay.y[i3])
+    l1 = ((y2-y3)*(x-x3)+(x3-x2)*(y-y3))/((y2-y3)*(x1-x3)+(x3-x2)*(y1-y3))
+    l2 = ((y3-y1)*(x-x3)+(x1-x3)*(y-y3))/((y2-y3)*(x1-x3)+(x3-x2)*(y1-y3))
+    l3 = 1-l1-l2
+
+    return float(l1*bx[i1]+l2*bx[i2]+l3*bx[i3]), float(l1*by[i1]+l2*by[i2]+l3*by[i3])
+
+def convexHull(xs, ys):
+    """ Returns the x and y arrays of the vertices of the convex hull of the points, counter-clockwise and not closed """
+    points = numpy.unique( numpy.column_stack((numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float))), axis=0 )
+
+    # Akl-Toussaint heuristic : points strictly inside the quadrilateral of the extreme points can't be on the hull,
+    # discarding them in bulk leaves very few points to the monotone chain loop below
+    quad = points[[numpy.argmin(points[:,0]), numpy.argmin(points[:,1]), numpy.argmax(points[:,0]), numpy.argmax(points[:,1])]]
+    inside = numpy.ones(len(points), dtype=bool)
+    for (x1, y1), (x2, y2) in zip(quad, numpy.roll(quad, -1, axis=0)):
+        inside &= (x2-x1)*(points[:,1]-y1)-(y2-y1)*(points[:,0]-x1) > 0
+    points = points[~inside].tolist()
+
+    # Andrew's monotone chain on the remaining (lexicographically sorted) points
+    def chain(points):
+        hull = []
+        for p in points:
+            while len(hull)>=2 and (hull[-1][0]-hull[-2][0])*(p[1]-hull[-2][1])-(hull[-1][1]-hull[-2][1])*(p[0]-hull[-2][0]) <= 0:
+                hull.pop()
+            hull.append(p)
+        return hull
+    hull = chain(points)[:-1]+chain(points[::-1])[:-1]
+
+    return numpy.array([p[0] for p in hull]), numpy.array([p[1] for p in hull])
+
+def bufferRing(hullX, hullY, buff, segments=3):
+    """ Returns the x and y arrays of the vertices of the convex hull offset by buff, with round corners made of
+    segments per quarter circle (like QgsGeometry.buffer(buff, segments)) """
+    xs, ys = [], []
+    step = math.pi/2.0/segments
+    n = len(hullX)
+    for i in range(n):
+        px, py = hullX[i-1], hullY[i-1]
+        cx, cy = hullX[i], hullY[i]
+        nx, ny = hullX[(i+1)%n], hullY[(i+1)%n]
+
+        # The hull is counter-clockwise, so the outward normals of the edges are on their right
+        start = math.atan2( -(cx-px), cy-py )
+        end = math.atan2( -(nx-cx), ny-cy )
+        while end < start:
+            end += 2*math.pi
+        count = max(1, int(math.ceil((end-start)/step)))
+        for k in range(count+1):
+            angle = start+(end-start)*k/count
+            xs.append( cx+buff*math.cos(angle) )
+            ys.append( cy+buff*math.sin(angle) )
+
+    return numpy.array(xs), numpy.array(ys)
+
+class Model():
+    """
+    Represents an abstract transformation type, from source points (ax, ay) to target points (bx, by).
+    This base model doesn't change the points.
+    """
+    def mapPoint(self, x, y):
+        return x, y
+
+    def mapArrays(self, xs, ys):
+        """ Maps arrays of x and y coordinates at once, returns a tuple of arrays """
+        """ This default implementation loops over mapPoint(), subclasses should override it with vectorized code """
+        mapped = [self.mapPoint(x, y) for x, y in zip(xs, ys)]
+        return numpy.array([p[0] for p in mapped], dtype=float), numpy.array([p[1] for p in mapped], dtype=float)
+
+
+class BendModel(Model):
+    """
+    Bending : the source points are triangulated, and points are mapped by their barycentric coordinates from the
+    triangle they are in to the same triangle on the target points. If buff is not 0, a ring of unmoved points is added
+    around the convex hull (offset by buff) so that the transformation smoothly stops.
+    """
+    def __init__(self, ax, ay, bx, by, buff):
+
+        # Make sure data is valid
+        assert len(ax)>=3
+        assert len(ax)==len(bx)
+
+        ax, ay = numpy.asarray(ax, dtype=float), numpy.asarray(ay, dtype=float)
+        bx, by = numpy.asarray(bx, dtype=float), numpy.asarray(by, dtype=float)
+
+        self.hullX, self.hullY = convexHull(ax, ay)
+
+        # If there is a buffer, we add a ring outside the hull so that the transformation smoothly stops
+        if buff>0:
+            self.ringX, self.ringY = bufferRing(self.hullX, self.hullY, buff)
+            ax, ay = numpy.concatenate((ax, self.ringX)), numpy.concatenate((ay, self.ringY))
+            bx, by = numpy.concatenate((bx, self.ringX)), numpy.concatenate((by, self.ringY))
+        else:
+            self.ringX, self.ringY = None, None
+
+        # We compute the delaunay
+        self.delaunay = matplotlib.tri.Triangulation(ax, ay)
+        self.trifinder = self.delaunay.get_trifinder()
+        self.bx, self.by = bx, by
+
+    def mapPoint(self, x, y):
+        return mapPointThroughTriangulation(self.delaunay, self.trifinder, self.bx, self.by, x, y)
+
+    def mapArrays(self, xs, ys):
+        return mapArraysThroughTriangulation(self.delaunay, self.trifinder, self.bx, self.by, xs, ys)
+
+
+class TiledBendModel(Model):
+    """
+    Bending for very large pairs networks : the pairs are partitioned into square tiles and each tile gets its own
+    (smaller) delaunay mesh, built lazily when a point falls into the tile and kept in a LRU cache.
+
+    Each tile mesh is built on the pairs of the tile and of an overlap band of 2*margin around it, plus the pairs on
+    the global convex hull and the buffer ring, so that all tile meshes cover the same area as the single mesh of
+    BendModel. Within margin of a tile border, points are mapped by a linear blend of the neighbouring tiles
+    meshes, which keeps the transformation continuous across tiles.
+    """
+
+    # Default number of tile meshes kept in memory
+    MAX_TILES = 64
+
+    def __init__(self, ax, ay, bx, by, buff, tileSize, maxTiles=MAX_TILES):
+
+        # Make sure data is valid
+        assert len(ax)>=3
+        assert len(ax)==len(bx)
+        assert tileSize>0
+
+        self.ax, self.ay = numpy.asarray(ax, dtype=float), numpy.asarray(ay, dtype=float)
+        self.bx, self.by = numpy.asarray(bx, dtype=float), numpy.asarray(by, dtype=float)
+
+        # The pairs on the hull and the buffer ring are part of every tile mesh
+        self.hullX, self.hullY = convexHull(self.ax, self.ay)
+        self.globalIndexes = numpy.unique([ numpy.flatnonzero((self.ax==x)&(self.ay==y))[0] for x, y in zip(self.hullX, self.hullY) ])
+        if buff>0:
+            self.ringX, self.ringY = bufferRing(self.hullX, self.hullY, buff)
+            outerX, outerY = self.ringX, self.ringY
+        else:
+            self.ringX, self.ringY = numpy.zeros(0), numpy.zeros(0)
+            outerX, outerY = self.hullX, self.hullY
+
+        # Points outside of this box are outside of every tile mesh
+        self.xMin, self.xMax = outerX.min(), outerX.max()
+        self.yMin, self.yMax = outerY.min(), outerY.max()
+
+        # Partition of the pairs in tiles, as (sorted) indexes of the pairs grouped by tile key
+        self.tileSize = float(tileSize)
+        self.margin = self.tileSize/4.0
+        self.rows = int(math.floor((self.yMax-self.yMin)/self.tileSize))+1
+        keys = self.tileKeys(self.ax, self.ay)
+        self.order = numpy.argsort(keys, kind='stable')
+        self.sortedKeys = keys[self.order]
+
+        self.maxTiles = maxTiles
+        self.tiles = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def tileKeys(self, xs, ys):
+        cols = numpy.floor((xs-self.xMin)/self.tileSize).astype(numpy.int64)
+        rows = numpy.floor((ys-self.yMin)/self.tileSize).astype(numpy.int64)
+        return cols*self.rows+rows
+
+    def tile(self, col, row):
+        """ Returns the (delaunay, trifinder, bx, by) mesh of the tile, building it if it isn't cached """
+        key = (col, row)
+        with self.lock:
+            mesh = self.tiles.get(key)
+            if mesh is not None:
+                self.tiles.move_to_end(key)
+                return mesh
+
+            # Pairs of the 3x3 neighbouring tiles (the overlap band is at most half a tile) restricted to the band
+            indexes = []
+            for c in (col-1, col, col+1):
+                for r in (row-1, row, row+1):
+                    if r < 0 or r >= self.rows:
+                        continue
+                    k = c*self.rows+r
+                    indexes.append( self.order[numpy.searchsorted(self.sortedKeys, k, 'left'):numpy.searchsorted(self.sortedKeys, k, 'right')] )
+            indexes = numpy.concatenate(indexes)
+            xMin = self.xMin+col*self.tileSize-2*self.margin
+            yMin = self.yMin+row*self.tileSize-2*self.margin
+            xMax = xMin+self.tileSize+4*self.margin
+            yMax = yMin+self.tileSize+4*self.margin
+            inBand = (self.ax[indexes]>=xMin)&(self.ax[indexes]<=xMax)&(self.ay[indexes]>=yMin)&(self.ay[indexes]<=yMax)
+            indexes = numpy.union1d(indexes[inBand], self.globalIndexes)
+
+            ax = numpy.concatenate((self.ax[indexes], self.ringX))
+            ay = numpy.concatenate((self.ay[indexes], self.ringY))
+            bx = numpy.concatenate((self.bx[indexes], self.ringX))
+            by = numpy.concatenate((self.by[indexes], self.ringY))
+            delaunay = matplotlib.tri.Triangulation(ax, ay)
+            mesh = (delaunay, delaunay.get_trifinder(), bx, by)
+
+            self.tiles[key] = mesh
+            if len(self.tiles) > self.maxTiles:
+                self.tiles.popitem(last=False)
+            return mesh
+
+    def blend(self, v, origin):
+        """ Returns (lowTile, highTile, highWeight) along one axis for the coordinate v """
+        i = int(math.floor((v-origin)/self.tileSize))
+        u = v-origin-i*self.tileSize
+        if u < self.margin:
+            return i-1, i, (u+self.margin)/(2*self.margin)
+        elif u > self.tileSize-self.margin:
+            return i, i+1, (u-self.tileSize+self.margin)/(2*self.margin)
+        return i, i+1, 0.0
+
+    def mapPoint(self, x, y):
+        if x<self.xMin or x>self.xMax or y<self.yMin or y>self.yMax:
+            return x, y
+
+        c0, c1, wc = self.blend(x, self.xMin)
+        r0, r1, wr = self.blend(y, self.yMin)
+
+        mx, my = 0.0, 0.0
+        for col, row, w in ((c0,r0,(1-wc)*(1-wr)), (c1,r0,wc*(1-wr)), (c0,r1,(1-wc)*wr), (c1,r1,wc*wr)):
+            if w <= 0:
+                continue
+            tx, ty = mapPointThroughTriangulation(*self.tile(col, row), x, y)
+            mx += w*tx
+            my += w*ty
+
+        return mx, my
+
+    def mapArrays(self, xs, ys):
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        mx = numpy.zeros(len(xs))
+        my = numpy.zeros(len(xs))
+
+        # Same blending as blend(), for all points at once
+        def blendArrays(v, origin):
+            i = numpy.floor((v-origin)/self.tileSize).astype(numpy.int64)
+            u = v-origin-i*self.tileSize
+            low = numpy.where(u < self.margin, i-1, i)
+            weight = numpy.where(u < self.margin, (u+self.margin)/(2*self.margin), numpy.where(u > self.tileSize-self.margin, (u-self.tileSize+self.margin)/(2*self.margin), 0.0))
+            return low, low+1, weight
+        c0, c1, wc = blendArrays(xs, self.xMin)
+        r0, r1, wr = blendArrays(ys, self.yMin)
+
+        # Outside of the meshes, points are not changed
+        outside = (xs<self.xMin)|(xs>self.xMax)|(ys<self.yMin)|(ys>self.yMax)
+        mx[outside] = xs[outside]
+        my[outside] = ys[outside]
+
+        # Contributions (tile, point, weight) of the four blended tiles of each point, grouped by tile so that each
+        # tile mesh is needed once per call, whatever the order of the points
+        cols = numpy.concatenate((c0, c1, c0, c1))
+        rows = numpy.concatenate((r0, r0, r1, r1))
+        weights = numpy.concatenate(((1-wc)*(1-wr), wc*(1-wr), (1-wc)*wr, wc*wr))
+        points = numpy.tile(numpy.arange(len(xs)), 4)
+        active = (weights > 0) & numpy.tile(~outside, 4)
+        cols, rows, weights, points = cols[active], rows[active], weights[active], points[active]
+
+        order = numpy.lexsort((rows, cols))
+        cols, rows, weights, points = cols[order], rows[order], weights[order], points[order]
+        starts = numpy.flatnonzero( numpy.diff(cols, prepend=cols[:1]-1) | numpy.diff(rows, prepend=rows[:1]-1) )
+        ends = numpy.append(starts[1:], len(points))
+
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            inTile = points[start:end]
+            tx, ty = mapArraysThroughTriangulation(*self.tile(int(cols[start]), int(rows[start])), xs[inTile], ys[inTile])
+            # Each point appears at most once per tile
+            mx[inTile] += weights[start:end]*tx
+            my[inTile] += weights[start:end]*ty
+
+        return mx, my
+
+class AffineModel(Model):
+    """
+    Affine transformation matching exactly three pairs
+    """
+    def __init__(self, ax, ay, bx, by):
+
+        # Make sure data is valid
+        assert len(ax)==3
+        assert len(ax)==len(bx)
+
+        """
+
+        MATRIX
+
+            [a,b,c] 
+        M = [d,e,f] 
+            [0,0,1]
+            
+               [x11]   [x12]
+        1] M * [y11] = [y12]
+               [ 1 ]   [ 1 ]
+
+               [x21]   [x22]
+        2] M * [y21] = [y22]
+               [ 1 ]   [ 1 ]
+
+               [x31]   [x32]
+        3] M * [y31] = [y32]
+               [ 1 ]   [ 1 ]
+
+               Equations to solve
+        [ 
+            a*x11+b*y11+c = x12,
+            d*x11+e*y11+f = y12,
+            a*x21+b*y21+c = x22,
+            d*x21+e*y21+f = y22,
+            a*x31+b*y31+c = x32,
+            d*x31+e*y31+f = y32]
+        For variables
+        [a,b,c,d,e,f]
+
+        Result using http://www.numberempire.com/equationsolver.php
+
+        a = (x12*(y31-y21)-x22*y31+x32*y21+(x22-x32)*y11)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        b = (x11*(x32-x22)-x21*x32+x22*x31+x12*(x21-x31))/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        c = -(x11*(x32*y21-x22*y31)+x12*(x21*y31-x31*y21)+(x22*x31-x21*x32)*y11)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        d = (y21*y32+y11*(y22-y32)+y12*(y31-y21)-y22*y31)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        e = -(x21*y32+x11*(y22-y32)-x31*y22+(x31-x21)*y12)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        f = (x11*(y22*y31-y21*y32)+y11*(x21*y32-x31*y22)+y12*(x31*y21-x21*y31))/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+
+        """
+
+        x11, y11 = float(ax[0]), float(ay[0])
+        x21, y21 = float(ax[1]), float(ay[1])
+        x31, y31 = float(ax[2]), float(ay[2])
+        x12, y12 = float(bx[0]), float(by[0])
+        x22, y22 = float(bx[1]), float(by[1])
+        x32, y32 = float(bx[2]), float(by[2])
+
+        self.a = (x12*(y31-y21)-x22*y31+x32*y21+(x22-x32)*y11)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        self.b = (x11*(x32-x22)-x21*x32+x22*x31+x12*(x21-x31))/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        self.c = -(x11*(x32*y21-x22*y31)+x12*(x21*y31-x31*y21)+(x22*x31-x21*x32)*y11)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        self.d = (y21*y32+y11*(y22-y32)+y12*(y31-y21)-y22*y31)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        self.e = -(x21*y32+x11*(y22-y32)-x31*y22+(x31-x21)*y12)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        self.f = (x11*(y22*y31-y21*y32)+y11*(x21*y32-x31*y22)+y12*(x31*y21-x21*y31))/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+
+    def mapPoint(self, x, y):
+        return self.a*x+self.b*y+self.c, self.d*x+self.e*y+self.f
+
+    def mapArrays(self, xs, ys):
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        return self.a*xs+self.b*ys+self.c, self.d*xs+self.e*ys+self.f
+
+
+class LinearModel(Model):
+    """
+    Uniform transformation (translation, rotation and scale) matching exactly two pairs
+    """
+    def __init__(self, ax, ay, bx, by):
+
+        # Make sure data is valid
+        assert len(ax)==2
+        assert len(ax)==len(bx)
+
+        ax1, ay1, ax2, ay2 = float(ax[0]), float(ay[0]), float(ax[1]), float(ay[1])
+        bx1, by1, bx2, by2 = float(bx[0]), float(by[0]), float(bx[1]), float(by[1])
+
+        #scale
+        self.ds = math.sqrt( (bx2-bx1)**2.0+(by2-by1)**2.0 ) / math.sqrt( (ax2-ax1)**2.0+(ay2-ay1)**2.0 )
+        #rotation
+        self.da =  math.atan2( by2-by1, bx2-bx1 ) - math.atan2( ay2-ay1, ax2-ax1 )
+        #translation
+        self.dx1 = ax1
+        self.dy1 = ay1
+        self.dx2 = bx1
+        self.dy2 = by1
+
+    def mapPoint(self, x, y):
+
+        #move to origin (translation part 1)
+        x, y = x-self.dx1, y-self.dy1
+
+        #scale
+        x, y = self.ds*x, self.ds*y
+
+        #rotation
+        x, y = math.cos(self.da)*x - math.sin(self.da)*y, math.sin(self.da)*x + math.cos(self.da)*y
+
+        #remove to right spot (translation part 2)
+        return x+self.dx2, y+self.dy2
+
+    def mapArrays(self, xs, ys):
+        xs = numpy.asarray(xs, dtype=float)-self.dx1
+        ys = numpy.asarray(ys, dtype=float)-self.dy1
+        cos = math.cos(self.da)*self.ds
+        sin = math.sin(self.da)*self.ds
+        return cos*xs-sin*ys+self.dx2, sin*xs+cos*ys+self.dy2
+
+
+class TranslationModel(Model):
+    """
+    Translation matching exactly one pair
+    """
+    def __init__(self, ax, ay, bx, by):
+
+        # Make sure data is valid
+        assert len(ax)==1
+        assert len(ax)==len(bx)
+
+        self.dx = float(bx[0])-float(ax[0])
+        self.dy = float(by[0])-float(ay[0])
+
+    def mapPoint(self, x, y):
+        return x+self.dx, y+self.dy
+
+    def mapArrays(self, xs, ys):
+        return numpy.asarray(xs, dtype=float)+self.dx, numpy.asarray(ys, dtype=float)+self.dy
+
+
+class DisplacementGrid():
+    """
+    Displacement field of a model sampled on a regular grid.
+
+    The field is stored in a memory-mapped temporary file (band 0 is dx, band 1 is dy, row 0 is the top of the grid)
+    so that fine grids don't need to fit in memory. Points are mapped by bilinear interpolation of the four surrounding
+    nodes, the interpolation error decreasing with the resolution.
+
+    estimatedError holds the largest error measured at the cells centres while sampling. It is an estimate and not a
+    bound : the field can bend more elsewhere within a cell (for instance around a pair closer than the resolution).
+    """
+
+    # Maximum number of nodes sampled at once
+    BLOCK_SIZE = 262144
+
+    def __init__(self, model, xMin, yMin, xMax, yMax, resolution):
+
+        assert resolution>0
+
+        self.resolution = float(resolution)
+        self.xMin = xMin
+        self.yMax = yMax
+        self.cols, self.rows = DisplacementGrid.size(xMin, yMin, xMax, yMax, resolution)
+
+        handle, self.path = tempfile.mkstemp(suffix='.npy', prefix='vectorbender_')
+        os.close(handle)
+        self.field = numpy.lib.format.open_memmap(self.path, mode='w+', dtype=numpy.float64, shape=(2,self.rows,self.cols))
+
+        # We sample block by block so that memory use doesn't depend on the grid size. Consecutive blocks share their
+        # border nodes, so that each cell is in exactly one block
+        xs = self.xMin+numpy.arange(self.cols)*self.resolution
+        ys = self.yMax-numpy.arange(self.rows)*self.resolution
+        if isinstance(model, TiledBendModel):
+            # Blocks are aligned to half tiles, so that each block needs at most 2x2 tile meshes (the blending bands
+            # are a quarter of a tile). They are swept in bands a few half tiles across (depending on the number of
+            # cached tiles) along the other axis, so that the tiles are still cached when the next block of the band
+            # needs them, and each tile mesh is built about once
+            side = max(1, int(math.sqrt(self.BLOCK_SIZE)))
+            colGroups = numpy.floor(2*(xs-model.xMin)/model.tileSize)
+            rowGroups = numpy.floor(2*(ys-model.yMin)/model.tileSize)
+            colRanges = DisplacementGrid.ranges(colGroups, side)
+            rowRanges = DisplacementGrid.ranges(rowGroups, side)
+            bandSize = max(1, 2*(model.maxTiles//3)-2)
+        else:
+            colGroups, rowGroups = numpy.zeros(self.cols), numpy.zeros(self.rows)
+            colRanges = DisplacementGrid.ranges(colGroups, self.cols)
+            rowRanges = DisplacementGrid.ranges(rowGroups, max(1, self.BLOCK_SIZE//self.cols))
+            bandSize = 1
+        if len(colRanges) <= len(rowRanges):
+            bands = numpy.abs(colGroups[[start for start, end in colRanges]]-colGroups[0])//bandSize
+            blocks = [(rowRange, colRange) for band in numpy.unique(bands) for rowRange in rowRanges for colRange, b in zip(colRanges, bands) if b == band]
+        else:
+            bands = numpy.abs(rowGroups[[start for start, end in rowRanges]]-rowGroups[0])//bandSize
+            blocks = [(rowRange, colRange) for band in numpy.unique(bands) for colRange in colRanges for rowRange, b in zip(rowRanges, bands) if b == band]
+
+        self.estimatedError = 0.0
+        for (r0, r1), (c0, c1) in blocks:
+            bx, by = numpy.meshgrid(xs[c0:c1+1], ys[r0:r1+1])
+            mx, my = model.mapArrays(bx.ravel(), by.ravel())
+            dx = mx.reshape(bx.shape)-bx
+            dy = my.reshape(by.shape)-by
+            self.field[0,r0:r1+1,c0:c1+1] = dx
+            self.field[1,r0:r1+1,c0:c1+1] = dy
+
+            # Compare the interpolated and the exact displacement at the centre of the cells of the block
+            centresX = (bx[:-1,:-1]+bx[1:,1:])/2.0
+            centresY = (by[:-1,:-1]+by[1:,1:])/2.0
+            cx, cy = model.mapArrays(centresX.ravel(), centresY.ravel())
+            ix = (dx[:-1,:-1]+dx[:-1,1:]+dx[1:,:-1]+dx[1:,1:])/4.0
+            iy = (dy[:-1,:-1]+dy[:-1,1:]+dy[1:,:-1]+dy[1:,1:])/4.0
+            error = numpy.hypot(cx-centresX.ravel()-ix.ravel(), cy-centresY.ravel()-iy.ravel()).max()
+            self.estimatedError = max(self.estimatedError, float(error))
+
+        self.field.flush()
+
+    @staticmethod
+    def ranges(groups, maxLength):
+        """
+        Returns the (start, end) inclusive ranges of nodes covering the groups (one group id per node, consecutive
+        nodes of a group being contiguous), split so that ranges have at most maxLength cells. Consecutive ranges
+        share their end node
+        """
+        bounds = [0]+(numpy.flatnonzero(numpy.diff(groups))+1).tolist()+[len(groups)-1]
+        ranges = []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            while start < end:
+                ranges.append( (start, min(end, start+maxLength)) )
+                start = ranges[-1][1]
+        return ranges
+
+    @staticmethod
+    def size(xMin, yMin, xMax, yMax, resolution):
+        """ Returns the (cols, rows) number of nodes of the grid covering the extent at the resolution """
+        cols = max(2, int(math.ceil((xMax-xMin)/float(resolution)))+1)
+        rows = max(2, int(math.ceil((yMax-yMin)/float(resolution)))+1)
+        return cols, rows
+
+    @staticmethod
+    def fileSize(cols, rows):
+        """ Returns the size in bytes of the memory-mapped file of a grid of cols x rows nodes """
+        return 2*8*cols*rows
+
+    def mapPoint(self, x, y):
+        """ Returns the mapped (x, y) tuple, or None if the point is outside of the grid """
+        col = (x-self.xMin)/self.resolution
+        row = (self.yMax-y)/self.resolution
+
+        if col<0 or row<0 or col>self.cols-1 or row>self.rows-1:
+            return None
+
+        c = min(int(col), self.cols-2)
+        r = min(int(row), self.rows-2)
+        fc = col-c
+        fr = row-r
+
+        cell = self.field[:,r:r+2,c:c+2]
+        dx = (cell[0,0,0]*(1-fc)+cell[0,0,1]*fc)*(1-fr)+(cell[0,1,0]*(1-fc)+cell[0,1,1]*fc)*fr
+        dy = (cell[1,0,0]*(1-fc)+cell[1,0,1]*fc)*(1-fr)+(cell[1,1,0]*(1-fc)+cell[1,1,1]*fc)*fr
+
+        return x+float(dx), y+float(dy)
+
+    def mapArrays(self, xs, ys):
+        """ Returns the mapped arrays, and the boolean array of the points that are inside of the grid (others are unchanged) """
+        xs = numpy.asarray(xs, dtype=float)
+        ys = numpy.asarray(ys, dtype=float)
+        col = (xs-self.xMin)/self.resolution
+        row = (self.yMax-ys)/self.resolution
+        inside = (col>=0)&(row>=0)&(col<=self.cols-1)&(row<=self.rows-1)
+
+        c = numpy.minimum(col[inside].astype(numpy.int64), self.cols-2)
+        r = numpy.minimum(row[inside].astype(numpy.int64), self.rows-2)
+        fc = col[inside]-c
+        fr = row[inside]-r
+
+        mx, my = xs.copy(), ys.copy()
+        for band, mapped in ((0, mx), (1, my)):
+            f = self.field[band]
+            mapped[inside] += (f[r,c]*(1-fc)+f[r,c+1]*fc)*(1-fr)+(f[r+1,c]*(1-fc)+f[r+1,c+1]*fc)*fr
+        return mx, my, inside
+
+    def exportGeoTiff(self, path, crsWkt=None):
+        """ Writes the field as a 2-band (dx, dy) float GeoTIFF, nodes being the pixels centres """
+        driver = gdal.GetDriverByName('GTiff')
+        dataset = driver.Create(path, self.cols, self.rows, 2, gdal.GDT_Float64, ['COMPRESS=DEFLATE','TILED=YES'])
+        dataset.SetGeoTransform( (self.xMin-self.resolution/2.0, self.resolution, 0.0, self.yMax+self.resolution/2.0, 0.0, -self.resolution) )
+        if crsWkt:
+            dataset.SetProjection( crsWkt )
+        for i,name in enumerate(['dx','dy']):
+            band = dataset.GetRasterBand(i+1)
+            band.SetDescription(name)
+            band.WriteArray( numpy.asarray(self.field[i]) )
+        dataset.FlushCache()
+        dataset = None
+
+    def close(self):
+        """ Releases the memory-mapped file """
+        if self.field is not None:
+            self.field = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+class GridModel(Model):
+    """
+    Grid evaluation mode : maps points through the DisplacementGrid of a model, falling back to the model itself for
+    points that are outside of the grid
+    """
+    def __init__(self, model, grid):
+        self.model = model
+        self.grid = grid
+
+    def mapPoint(self, x, y):
+        mapped = self.grid.mapPoint(x, y)
+        if mapped is None:
+            return self.model.mapPoint(x, y)
+        return mapped
+
+    def mapArrays(self, xs, ys):
+        mx, my, inside = self.grid.mapArrays(xs, ys)
+        if not numpy.all(inside):
+            mx[~inside], my[~inside] = self.model.mapArrays(mx[~inside], my[~inside])
+        return mx, my
+
+
+def createModel(ax, ay, bx, by, buff=0.0, tileSize=0.0, maxTiles=TiledBendModel.MAX_TILES):
+    """
+    Returns the model matching the number of pairs : translation (1 pair), linear (2 pairs), affine (3 pairs) or
+    bending (4 or more pairs, tiled if tileSize isn't 0)
+    """
+    count = len(ax)
+    if count == 1:
+        return TranslationModel(ax, ay, bx, by)
+    elif count == 2:
+        return LinearModel(ax, ay, bx, by)
+    elif count == 3:
+        return AffineModel(ax, ay, bx, by)
+    elif count >= 4 and tileSize > 0:
+        return TiledBendModel(ax, ay, bx, by, buff, tileSize, maxTiles)
+    elif count >= 4:
+        return BendModel(ax, ay, bx, by, buff)
+    raise ValueError("At least one pair is needed")
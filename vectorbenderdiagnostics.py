@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+from qgis.PyQt.QtCore import QVariant
+from qgis.core import *
+
+import numpy
+
+try:
+    #we silently fail the import here since message is already taken car in vectorbender.py
+    import matplotlib.tri
+except Exception:
+    pass
+
+
+class PairsDiagnostics():
+    """
+    Quality diagnostics of a set of pairs, computed in bulk (numpy arrays, no python loop over the pairs) over the
+    delaunay triangulation of their source points :
+        - duplicate source points
+        - collinear input (no triangulation possible)
+        - flipped (orientation reversed by the mapping) and near-degenerate triangles
+        - local scale and shear (anisotropy) of the affine mapping of each triangle
+        - outlier pairs, whose displacement differs a lot from the one of their neighbours in the mesh
+    """
+
+    # Triangles with a shape quality below this (1 is equilateral, 0 is flat) are near-degenerate
+    DEGENERATE_QUALITY = 0.01
+    # Pairs with a robust z-score of their displacement residual above this are outliers
+    OUTLIER_SCORE = 3.5
+
+    def __init__(self, ax, ay, bx, by):
+
+        self.ax = numpy.asarray(ax, dtype=float)
+        self.ay = numpy.asarray(ay, dtype=float)
+        self.bx = numpy.asarray(bx, dtype=float)
+        self.by = numpy.asarray(by, dtype=float)
+        self.count = len(self.ax)
+
+        # Duplicate source points
+        distinct, inverse, counts = numpy.unique( numpy.column_stack((self.ax,self.ay)), axis=0, return_inverse=True, return_counts=True )
+        self.duplicated = counts[inverse.ravel()] > 1
+
+        # Collinear input (also true if there are less than 3 distinct points)
+        if len(distinct) < 3:
+            self.collinear = True
+        else:
+            centered = distinct-distinct.mean(axis=0)
+            singular = numpy.linalg.svd(centered, compute_uv=False)
+            self.collinear = singular[-1] <= 1e-12*singular[0]
+
+        self.delaunay = None
+        self.triangles = numpy.zeros((0,3), dtype=int)
+        if not self.collinear:
+            self.delaunay = matplotlib.tri.Triangulation(self.ax, self.ay)
+            self.triangles = self.delaunay.triangles
+
+        self.computeTriangles()
+        self.computeOutliers()
+
+    def computeTriangles(self):
+        t = self.triangles
+        i1, i2, i3 = t[:,0], t[:,1], t[:,2]
+
+        # Edges of the triangles as (u, v) vectors, in the source and target meshes
+        aux, auy = self.ax[i2]-self.ax[i1], self.ay[i2]-self.ay[i1]
+        avx, avy = self.ax[i3]-self.ax[i1], self.ay[i3]-self.ay[i1]
+        bux, buy = self.bx[i2]-self.bx[i1], self.by[i2]-self.by[i1]
+        bvx, bvy = self.bx[i3]-self.bx[i1], self.by[i3]-self.by[i1]
+
+        # Signed double areas
+        detA = aux*avy-avx*auy
+        detB = bux*bvy-bvx*buy
+
+        self.flipped = detA*detB <= 0
+
+        def quality(det, ux, uy, vx, vy):
+            edges = ux**2+uy**2 + vx**2+vy**2 + (vx-ux)**2+(vy-uy)**2
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                return numpy.where(edges > 0, 2.0*numpy.sqrt(3.0)*numpy.abs(det)/edges, 0.0)
+        self.qualityA = quality(detA, aux, auy, avx, avy)
+        self.qualityB = quality(detB, bux, buy, bvx, bvy)
+        self.degenerate = (self.qualityA < self.DEGENERATE_QUALITY) | (self.qualityB < self.DEGENERATE_QUALITY)
+
+        # Jacobian J = EB * EA^-1 of the affine mapping of each triangle, EA and EB having the edges as columns
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            a = (bux*avy-bvx*auy)/detA
+            b = (bvx*aux-bux*avx)/detA
+            c = (buy*avy-bvy*auy)/detA
+            d = (bvy*aux-buy*avx)/detA
+
+            # Closed form singular values of the 2x2 jacobians
+            q = numpy.hypot((a+d)/2.0, (c-b)/2.0)
+            r = numpy.hypot((a-d)/2.0, (c+b)/2.0)
+            smax = q+r
+            smin = numpy.abs(q-r)
+
+            self.scale = numpy.sqrt(numpy.abs(a*d-b*c))
+            self.shear = numpy.where(smin > 0, smax/smin, numpy.inf)
+
+    def computeOutliers(self):
+        self.residuals = numpy.zeros(self.count)
+        self.outliers = numpy.zeros(self.count, dtype=bool)
+
+        if self.delaunay is None:
+            return
+
+        # Difference between the displacement of each pair and the mean displacement of its neighbours in the mesh
+        dx, dy = self.bx-self.ax, self.by-self.ay
+        edges = self.delaunay.edges
+        start = numpy.concatenate((edges[:,0], edges[:,1]))
+        end = numpy.concatenate((edges[:,1], edges[:,0]))
+        neighbours = numpy.bincount(start, minlength=self.count)
+        connected = neighbours > 0
+        meanX = numpy.bincount(start, weights=dx[end], minlength=self.count)[connected]/neighbours[connected]
+        meanY = numpy.bincount(start, weights=dy[end], minlength=self.count)[connected]/neighbours[connected]
+        self.residuals[connected] = numpy.hypot(dx[connected]-meanX, dy[connected]-meanY)
+
+        # Robust z-score (median absolute deviation)
+        residuals = self.residuals[connected]
+        median = numpy.median(residuals)
+        mad = numpy.median(numpy.abs(residuals-median))
+        if mad > 0:
+            self.outliers[connected] = 0.6745*(residuals-median)/mad > self.OUTLIER_SCORE
+
+    def isValid(self):
+        """ Returns whether the pairs can be used for the bending transformation """
+        return not self.collinear and not numpy.any(self.duplicated)
+
+    def report(self):
+        """ Returns a human readable report as a list of lines """
+        lines = []
+        lines.append( "%i pairs, %i triangles" % (self.count, len(self.triangles)) )
+        lines.append( "Duplicate source points : %i pairs" % numpy.count_nonzero(self.duplicated) )
+        if self.collinear:
+            lines.append( "Collinear input : the source points can't be triangulated !" )
+        else:
+            lines.append( "Flipped triangles : %i" % numpy.count_nonzero(self.flipped) )
+            lines.append( "Near-degenerate triangles : %i" % numpy.count_nonzero(self.degenerate) )
+            finite = numpy.isfinite(self.scale)
+            if numpy.any(finite):
+                lines.append( "Local scale : min %.3f, median %.3f, max %.3f" % (self.scale[finite].min(), numpy.median(self.scale[finite]), self.scale[finite].max()) )
+            finite = numpy.isfinite(self.shear)
+            if numpy.any(finite):
+                lines.append( "Local shear (anisotropy) : median %.3f, max %.3f" % (numpy.median(self.shear[finite]), self.shear[finite].max()) )
+            lines.append( "Outlier pairs : %i" % numpy.count_nonzero(self.outliers) )
+        return lines
+
+    def trianglesLayer(self, crs):
+        """ Returns a memory layer with the source triangles and their diagnostics """
+        layer = QgsVectorLayer("Polygon", "Vector Bender triangles diagnostics", "memory")
+        layer.setCrs(crs)
+        layer.dataProvider().addAttributes([
+            QgsField("flipped", QVariant.Bool),
+            QgsField("degenerate", QVariant.Bool),
+            QgsField("quality", QVariant.Double),
+            QgsField("scale", QVariant.Double),
+            QgsField("shear", QVariant.Double),
+        ])
+        layer.updateFields()
+
+        features = []
+        for i,t in enumerate(self.triangles):
+            feature = QgsFeature(layer.fields())
+            feature.setGeometry( QgsGeometry.fromPolygonXY( [[QgsPointXY(self.ax[j],self.ay[j]) for j in (t[0],t[1],t[2],t[0])]] ) )
+            feature.setAttributes( [bool(self.flipped[i]), bool(self.degenerate[i]), float(min(self.qualityA[i],self.qualityB[i])), float(self.scale[i]), float(self.shear[i])] )
+            features.append( feature )
+        layer.dataProvider().addFeatures( features )
+        layer.updateExtents()
+        return layer
+
+    def pairsLayer(self, crs):
+        """ Returns a memory layer with the pairs that are duplicated or outliers """
+        layer = QgsVectorLayer("Linestring", "Vector Bender pairs diagnostics", "memory")
+        layer.setCrs(crs)
+        layer.dataProvider().addAttributes([
+            QgsField("duplicate", QVariant.Bool),
+            QgsField("outlier", QVariant.Bool),
+            QgsField("residual", QVariant.Double),
+        ])
+        layer.updateFields()
+
+        features = []
+        for i in numpy.flatnonzero(self.duplicated | self.outliers):
+            feature = QgsFeature(layer.fields())
+            feature.setGeometry( QgsGeometry.fromPolylineXY( [QgsPointXY(self.ax[i],self.ay[i]), QgsPointXY(self.bx[i],self.by[i])] ) )
+            feature.setAttributes( [bool(self.duplicated[i]), bool(self.outliers[i]), float(self.residuals[i])] )
+            features.append( feature )
+        layer.dataProvider().addFeatures( features )
+        layer.updateExtents()
+        return layer
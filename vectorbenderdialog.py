@@ -10,9 +10,16 @@ from qgis.gui import *
 import os.path
 
 from .vectorbendertransformers import *
+from .vectorbenderdiagnostics import PairsDiagnostics
 
 
 class VectorBenderDialog(QtWidgets.QDialog):
+
+    # Prefix of the comboBox_toBendLayer data for layer groups (other items data are layer ids)
+    GROUP_PREFIX = "group:"
+    # Pairs are counted up to this when the provider doesn't know the count, since it's enough to tell the transformation types apart
+    PAIRS_COUNT_LIMIT = 4
+
     def __init__(self, iface, vb):
         QtWidgets.QDialog.__init__(self)
         uic.loadUi(os.path.join(os.path.dirname(__file__),'ui_main.ui'), self)
@@ -31,51 +38,143 @@ class VectorBenderDialog(QtWidgets.QDialog):
         self.previewButton.pressed.connect(self.showPreview)
         self.previewButton.released.connect(self.hidePreview)
 
+        self.diagnosticsButton.clicked.connect(self.showDiagnostics)
+
         self.editModeButton_toBendLayer.clicked.connect(self.toggleEditMode_toBendLayer)
         self.editModeButton_pairsLayer.clicked.connect(self.toggleEditMode_pairsLayer)
 
         self.runButton.clicked.connect(self.vb.run)
 
+        self.exportGridButton.clicked.connect(self.exportGrid)
+
         # When those are changed, we recheck the requirements
         self.editModeButton_pairsLayer.clicked.connect(self.checkRequirements)
         self.editModeButton_toBendLayer.clicked.connect(self.checkRequirements)
-        self.comboBox_toBendLayer.activated.connect( self.checkRequirements )
+        self.comboBox_toBendLayer.checkedItemsChanged.connect( self.checkRequirements )
         self.pairsToPinsCheckBox.clicked.connect( self.checkRequirements )
 
         # When those are changed, we change the transformation type (which also checks the requirements)
-        self.comboBox_toBendLayer.activated.connect( self.updateEditState_toBendLayer )
+        self.comboBox_toBendLayer.checkedItemsChanged.connect( self.updateEditState_toBendLayer )
         self.comboBox_pairsLayer.activated.connect( self.updateEditState_pairsLayer )
         self.comboBox_pairsLayer.activated.connect( self.updateTransformationType )
         self.restrictBox_pairsLayer.stateChanged.connect( self.updateTransformationType )
 
+        # When those are changed, we watch the signals of other layers
+        self.comboBox_toBendLayer.checkedItemsChanged.connect( self.watchLayers )
+        self.comboBox_pairsLayer.activated.connect( self.watchLayers )
+
+        # While bending or exporting, the events are processed to show the progress, so the buttons are kept disabled to
+        # avoid starting another job (checkRequirements sets ready, which is restored once the job is over)
+        self.busy = False
+        self.ready = False
+
+        # The UI state is cached : it's only refreshed on focus when the project or layers signals tell it's outdated
+        self.dirty = True
+        self.watchedConnections = []
+        # Group nodes of the comboBox_toBendLayer items, by path
+        self.comboGroups = {}
+        QgsProject.instance().layersAdded.connect( self.invalidate )
+        QgsProject.instance().layersRemoved.connect( self.invalidate )
+        QgsProject.instance().layerTreeRoot().addedChildren.connect( self.invalidate )
+        QgsProject.instance().layerTreeRoot().removedChildren.connect( self.invalidate )
+        # Renaming a layer or a group changes the comboboxes items (groups are checked by path), the layer tree nodes
+        # propagate the nameChanged signal of their children up to the root
+        QgsProject.instance().layerTreeRoot().nameChanged.connect( self.invalidate )
+
+        # Cached number of pairs for (pairs layer id, restricted to selection), and background task counting them
+        self.pairsCountKey = None
+        self.pairsCountValue = 0
+        self.pairsCountGeneration = 0
+        self.countTask = None
+
         # Create an event filter to update on focus
         self.installEventFilter(self)
 
 
     # UI Getters
-    def toBendLayer(self):
+    def toBendLayers(self):
         """
-        Returns the current toBend layer depending on what is choosen in the comboBox_pairsLayer
+        Returns the list of layers to bend depending on what is checked in the comboBox_toBendLayer. Checked groups
+        are replaced by the vector layers they contain (except the pairs layer).
         """
-        layerId = self.comboBox_toBendLayer.itemData(self.comboBox_toBendLayer.currentIndex())
-        return QgsProject.instance().mapLayer(layerId)
+        layers = []
+        groups = dict(self.layerGroups())
+        pairsLayer = self.pairsLayer()
+        for data in self.comboBox_toBendLayer.checkedItemsData():
+            if data.startswith(self.GROUP_PREFIX):
+                group = groups.get(data[len(self.GROUP_PREFIX):])
+                if group is None:
+                    continue
+                for treeLayer in group.findLayers():
+                    layer = treeLayer.layer()
+                    if layer is not None and layer.type() == QgsMapLayer.VectorLayer and layer is not pairsLayer and layer not in layers:
+                        layers.append( layer )
+            else:
+                layer = QgsProject.instance().mapLayer(data)
+                if layer is not None and layer not in layers:
+                    layers.append( layer )
+        return layers
     def pairsLayer(self):
         """
         Returns the current pairsLayer layer depending on what is choosen in the comboBox_pairsLayer
         """
         layerId = self.comboBox_pairsLayer.itemData(self.comboBox_pairsLayer.currentIndex())
         return QgsProject.instance().mapLayer(layerId)
+    def pairsCount(self):
+        """
+        Returns the number of pairs (or of selected pairs if restricted to selection), cached until the pairs layer
+        signals a change. If the provider doesn't know its features count, they are counted (up to PAIRS_COUNT_LIMIT)
+        by a background task, and None is returned until it's finished.
+        """
+        pl = self.pairsLayer()
+        if pl is None:
+            return 0
+
+        key = self.pairsCountCurrentKey()
+        if self.pairsCountKey == key:
+            return self.pairsCountValue
+
+        count = pl.selectedFeatureCount() if key[1] else pl.featureCount()
+        if count < 0:
+            self.countPairs(pl, key)
+            return None
+
+        self.pairsCountKey = key
+        self.pairsCountValue = count
+        return count
+    def pairsCountCurrentKey(self):
+        """
+        Returns the (pairs layer id, restricted to selection) key of the cached number of pairs
+        """
+        pl = self.pairsLayer()
+        return (pl.id() if pl is not None else None, self.restrictBox_pairsLayer.isChecked())
     def bufferValue(self):
         """
         Returns the current buffer value depending on the input in the spinbox
         """
         return self.bufferSpinBox.value()
+    def tileSizeValue(self):
+        """
+        Returns the current tile size depending on the input in the spinbox (0 meaning a single mesh)
+        """
+        return self.tileSizeSpinBox.value()
+    def maxTilesValue(self):
+        """
+        Returns the number of tile meshes kept in memory depending on the input in the spinbox
+        """
+        return self.maxTilesSpinBox.value()
+    def gridResolutionValue(self):
+        """
+        Returns the current displacement grid resolution depending on the input in the spinbox
+        """
+        return self.gridResolutionSpinBox.value()
 
     # Updaters
     def refreshStates(self):
         """
         Updates the UI values, to be used upon opening / activating the window
         """
+        self.dirty = False
 
         # Update the comboboxes
         self.updateLayersComboboxes()
@@ -86,55 +185,92 @@ class VectorBenderDialog(QtWidgets.QDialog):
 
         # Update the transformation type
         self.updateTransformationType()
+
+        self.watchLayers()
+    def invalidate(self, *args):
+        """
+        Marks the UI state as outdated, so that it's refreshed the next time the window is activated
+        """
+        self.dirty = True
+    def invalidatePairsCount(self, *args):
+        """
+        Marks the cached number of pairs (and the UI state) as outdated
+        """
+        self.pairsCountKey = None
+        self.pairsCountGeneration += 1
+        self.invalidate()
     def checkRequirements(self):
         """
         To be run after changes have been made to the UI. It enables/disables the run button and display some messages.
         """
         # Checkin requirements
+        self.ready = False
         self.runButton.setEnabled(False)
 
-        tbl = self.toBendLayer()
+        tbls = self.toBendLayers()
         pl = self.pairsLayer()
 
-        if tbl is None:
-            self.displayMsg( "You must select a vector layer to bend !", True )
+        if len(tbls) == 0:
+            self.displayMsg( "You must select at least one vector layer to bend !", True )
             return
         if pl is None:
             self.displayMsg( "You must select a vector (line) layer which defines the points pairs !", True )
             return
-        if pl is tbl:
-            self.displayMsg( "The layer to bend must be different from the pairs layer !", True )
+        if pl in tbls:
+            self.displayMsg( "The layers to bend must be different from the pairs layer !", True )
             return            
-        if not tbl.isEditable():
-            self.displayMsg( "The layer to bend must be in edit mode !", True )
-            return
+        for tbl in tbls:
+            if not tbl.isEditable():
+                self.displayMsg( "The layer to bend %s must be in edit mode !" % tbl.name(), True )
+                return
         if not pl.isEditable() and self.pairsToPinsCheckBox.isChecked():
             self.displayMsg( "The pairs layer must be in edit mode if you want to change pairs to pins !", True )
             return
+        if self.stackedWidget.currentIndex() == 0 and self.countTask is not None:
+            self.displayMsg("Counting the pairs...")
+            return
         if self.stackedWidget.currentIndex() == 0:
             self.displayMsg("Impossible to run with an invalid transformation type.", True)
             return            
-        self.displayMsg("Ready to go...")
-        self.runButton.setEnabled(True)
+        reprojected = [tbl.name() for tbl in tbls if tbl.crs() != pl.crs()]
+        if reprojected:
+            self.displayMsg("Ready to go... (%s will be reprojected to the CRS of the pairs while bending)" % ", ".join(reprojected))
+        else:
+            self.displayMsg("Ready to go...")
+        self.ready = True
+        self.runButton.setEnabled(not self.busy)
+    def setBusy(self, busy):
+        """
+        Disables the run and export buttons while a job is running, and restores them afterwards
+        """
+        self.busy = busy
+        self.runButton.setEnabled(self.ready and not busy)
+        self.exportGridButton.setEnabled(not busy)
 
     def updateLayersComboboxes(self):
         """
         Recreate the comboboxes to display existing layers.
         """
-        oldBendLayer = self.toBendLayer()
+        oldBendData = self.comboBox_toBendLayer.checkedItemsData()
         oldPairsLayer = self.pairsLayer()
+        # Checked groups are kept checked by node rather than by path, so that they stay checked once renamed or moved
+        oldGroups = [self.comboGroups.get(data[len(self.GROUP_PREFIX):]) for data in oldBendData if data.startswith(self.GROUP_PREFIX)]
 
+        self.comboBox_toBendLayer.blockSignals(True)
         self.comboBox_toBendLayer.clear()
         self.comboBox_pairsLayer.clear()
+        self.comboGroups = {}
+        for path, group in self.layerGroups():
+            data = self.GROUP_PREFIX+path
+            self.comboGroups[path] = group
+            self.comboBox_toBendLayer.addItemWithCheckState( "Group : "+path, Qt.Checked if any(group is oldGroup for oldGroup in oldGroups) else Qt.Unchecked, data )
         for layer in QgsProject.instance().mapLayers().values():
             if layer.type() == QgsMapLayer.VectorLayer:
-                self.comboBox_toBendLayer.addItem( layer.name(), layer.id() )
+                self.comboBox_toBendLayer.addItemWithCheckState( layer.name(), Qt.Checked if layer.id() in oldBendData else Qt.Unchecked, layer.id() )
                 if layer.geometryType() == QgsWkbTypes.LineGeometry :
                     self.comboBox_pairsLayer.addItem( layer.name(), layer.id() )
+        self.comboBox_toBendLayer.blockSignals(False)
 
-        if oldBendLayer is not None:
-            index = self.comboBox_toBendLayer.findData(oldBendLayer.id())
-            self.comboBox_toBendLayer.setCurrentIndex( index )
         if oldPairsLayer is not None:
             index = self.comboBox_pairsLayer.findData(oldPairsLayer.id())
             self.comboBox_pairsLayer.setCurrentIndex( index )
@@ -146,10 +282,10 @@ class VectorBenderDialog(QtWidgets.QDialog):
         self.editModeButton_pairsLayer.setChecked( False if (l is None or not l.isEditable()) else True )
     def updateEditState_toBendLayer(self):
         """
-        Update the edit state button for toBendLayer
+        Update the edit state button for the layers to bend (checked only if they all are editable)
         """
-        l = self.toBendLayer()
-        self.editModeButton_toBendLayer.setChecked( False if (l is None or not l.isEditable()) else True )
+        ls = self.toBendLayers()
+        self.editModeButton_toBendLayer.setChecked( len(ls) > 0 and all(l.isEditable() for l in ls) )
     def updateTransformationType(self):
         """
         Update the stacked widget to display the proper transformation type. Also runs checkRequirements() 
@@ -161,28 +297,115 @@ class VectorBenderDialog(QtWidgets.QDialog):
 
     # Togglers
     def toggleEditMode(self, checked, toBendLayer_True_pairsLayer_False):
-        l = self.toBendLayer() if toBendLayer_True_pairsLayer_False else self.pairsLayer()
-        if l is None:
-            return 
+        ls = self.toBendLayers() if toBendLayer_True_pairsLayer_False else [self.pairsLayer()]
 
-        if checked:
-            l.startEditing()
-        else:
-            if not l.isModified():
-                l.rollBack()
-            else:
-                retval = QMessageBox.warning(self, "Stop editting", "Do you want to save the changes to layer %s ?" % l.name(), QMessageBox.Save | QMessageBox.Discard | QMessageBox.Cancel, QMessageBox.Save)
+        for l in ls:
+            if l is None:
+                continue
 
-                if retval == QMessageBox.Save:
-                    l.commitChanges()
-                elif retval == QMessageBox.Discard:
+            if checked:
+                if not l.isEditable():
+                    l.startEditing()
+            elif l.isEditable():
+                if not l.isModified():
                     l.rollBack()
+                else:
+                    retval = QMessageBox.warning(self, "Stop editting", "Do you want to save the changes to layer %s ?" % l.name(), QMessageBox.Save | QMessageBox.Discard | QMessageBox.Cancel, QMessageBox.Save)
+
+                    if retval == QMessageBox.Save:
+                        l.commitChanges()
+                    elif retval == QMessageBox.Discard:
+                        l.rollBack()
     def toggleEditMode_toBendLayer(self, checked):
         self.toggleEditMode(checked, True)
     def toggleEditMode_pairsLayer(self, checked):
         self.toggleEditMode(checked, False)
 
+    # Signals
+    def watchLayers(self, *args):
+        """
+        Connects the signals of the pairs layer and of the layers to bend that change the UI state, instead of the
+        previously watched ones
+        """
+        self.unwatchLayers()
+
+        connections = []
+        pl = self.pairsLayer()
+        if pl is not None:
+            for signal in (pl.featureAdded, pl.featureDeleted, pl.selectionChanged, pl.editingStarted, pl.editingStopped):
+                connections.append( (signal, self.invalidatePairsCount) )
+        for tbl in self.toBendLayers():
+            for signal in (tbl.editingStarted, tbl.editingStopped, tbl.crsChanged):
+                connections.append( (signal, self.invalidate) )
+
+        for signal, slot in connections:
+            signal.connect( slot )
+        self.watchedConnections = connections
+    def unwatchLayers(self):
+        for signal, slot in self.watchedConnections:
+            try:
+                signal.disconnect( slot )
+            except (TypeError, RuntimeError):
+                # The layer was deleted in the meantime
+                pass
+        self.watchedConnections = []
+    def disconnectSignals(self):
+        """
+        Disconnects the project and layers signals, to be used when the plugin is unloaded
+        """
+        self.unwatchLayers()
+        QgsProject.instance().layersAdded.disconnect( self.invalidate )
+        QgsProject.instance().layersRemoved.disconnect( self.invalidate )
+        QgsProject.instance().layerTreeRoot().addedChildren.disconnect( self.invalidate )
+        QgsProject.instance().layerTreeRoot().removedChildren.disconnect( self.invalidate )
+        QgsProject.instance().layerTreeRoot().nameChanged.disconnect( self.invalidate )
+
     # Misc
+    def countPairs(self, pairsLayer, key):
+        """
+        Counts the pairs (up to PAIRS_COUNT_LIMIT) in a background task, and updates the transformation type once done
+        """
+        generation = self.pairsCountGeneration
+        if self.countTask is not None and self.countTask.countKey == (key, generation):
+            # Already being counted
+            return
+
+        source = QgsVectorLayerFeatureSource( pairsLayer )
+        request = QgsFeatureRequest().setNoAttributes().setFlags(QgsFeatureRequest.NoGeometry).setLimit(self.PAIRS_COUNT_LIMIT)
+
+        def count(task):
+            return sum(1 for feature in source.getFeatures(request))
+
+        def finished(exception, result=None):
+            if self.countTask is task:
+                self.countTask = None
+            if exception is not None:
+                QgsMessageLog.logMessage("Could not count the pairs : %s" % exception, 'VectorBender')
+                return
+            if (key, generation) != (self.pairsCountCurrentKey(), self.pairsCountGeneration):
+                # Outdated by a change of the pairs layer in the meantime
+                return
+            self.pairsCountKey = key
+            self.pairsCountValue = result
+            self.updateTransformationType()
+
+        task = QgsTask.fromFunction( "Counting Vector Bender pairs", count, on_finished=finished )
+        task.countKey = (key, generation)
+        self.countTask = task
+        QgsApplication.taskManager().addTask( task )
+    def layerGroups(self):
+        """
+        Returns (path, group) tuples for all the groups of the layer tree, path being the slash separated names of the group and its parents
+        """
+        groups = []
+        def walk(parent, prefix):
+            for child in parent.children():
+                if QgsLayerTree.isGroup(child):
+                    path = prefix+child.name()
+                    groups.append( (path, child) )
+                    walk(child, path+"/")
+        walk(QgsProject.instance().layerTreeRoot(), "")
+        return groups
     def createMemoryLayer(self):
         """
         Creates a new memory layer to be used as pairLayer, and selects it in the ComboBox.
@@ -204,6 +427,33 @@ class VectorBenderDialog(QtWidgets.QDialog):
         self.comboBox_pairsLayer.setCurrentIndex( index )
         
         newMemoryLayer.startEditing()  
+    def exportGrid(self):
+        """
+        Samples the displacement field over the layer to bend and saves it as a 2-band GeoTIFF
+        """
+        if len(self.toBendLayers()) == 0 or self.stackedWidget.currentIndex() in (0, 5):
+            self.displayMsg( "You need a layer to bend and a valid transformation type to export the displacement grid !", True )
+            return
+
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, "Export displacement grid", "", "GeoTIFF (*.tif *.tiff)")
+        if not path:
+            return
+
+        self.setBusy(True)
+        try:
+            transformer = self.vb.createTransformer()
+            if transformer is None:
+                return
+            grid = self.vb.createGrid( transformer, self.toBendLayers() )
+            if grid is None:
+                return
+            # The grid is sampled in the CRS of the pairs (see VectorBender.createGrid)
+            grid.exportGeoTiff( path, self.pairsLayer().crs().toWkt() )
+            grid.close()
+        finally:
+            self.setBusy(False)
+
+        self.displayMsg( "Displacement grid of %i x %i nodes exported (estimated interpolation error %f)" % (grid.cols, grid.rows, grid.estimatedError) )
     def displayMsg(self, msg, error=False):
         if error:
             #QApplication.beep()
@@ -256,14 +506,36 @@ class VectorBenderDialog(QtWidgets.QDialog):
             self.rubberBands[0].addPoint( p, True, 0  )
 
         #draw the triangles
+        x, y = transformer.delaunay.x, transformer.delaunay.y
         for i,tri in enumerate(transformer.delaunay.triangles):
-            self.rubberBands[2].addPoint( transformer.pointsA[tri[0]], False, i  )
-            self.rubberBands[2].addPoint( transformer.pointsA[tri[1]], False, i  )
-            self.rubberBands[2].addPoint( transformer.pointsA[tri[2]], True, i  ) #TODO : this refreshes the rubber band on each triangle, it should be updated only once after this loop       
+            self.rubberBands[2].addPoint( QgsPointXY(x[tri[0]],y[tri[0]]), False, i  )
+            self.rubberBands[2].addPoint( QgsPointXY(x[tri[1]],y[tri[1]]), False, i  )
+            self.rubberBands[2].addPoint( QgsPointXY(x[tri[2]],y[tri[2]]), True, i  ) #TODO : this refreshes the rubber band on each triangle, it should be updated only once after this loop       
+
+    def showDiagnostics(self):
+        """
+        Computes the quality diagnostics of the pairs, displays the report and adds the diagnostics layers to the project
+        """
+        pairsLayer = self.pairsLayer()
+        if pairsLayer is None:
+            return
+
+        self.displayMsg( "Computing pairs diagnostics..." )
+        QCoreApplication.processEvents()
+
+        pairs = Transformer( pairsLayer, self.restrictBox_pairsLayer.isChecked() )
+        diagnostics = PairsDiagnostics( pairs.ax, pairs.ay, pairs.bx, pairs.by )
+
+        QgsProject.instance().addMapLayer( diagnostics.trianglesLayer(pairsLayer.crs()) )
+        QgsProject.instance().addMapLayer( diagnostics.pairsLayer(pairsLayer.crs()) )
+
+        report = diagnostics.report()
+        self.displayMsg( "Pairs diagnostics : "+", ".join(report[1:]), not diagnostics.isValid() )
+        QMessageBox.information(self, "Pairs diagnostics", "\n".join(report))
 
     # Events
     def eventFilter(self,object,event):
-        if event.type() == QEvent.WindowActivate:
+        if event.type() == QEvent.WindowActivate and self.dirty:
             self.refreshStates()
         return False
 
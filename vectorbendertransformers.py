@@ -1,233 +1,289 @@
 # -*- coding: utf-8 -*-
 from qgis.core import *
-import math
+import array
+import threading
 
-try:
-    #we silently fail the import here since message is already taken car in vectorbender.py
-    import matplotlib.tri
-except Exception:
-    pass
+import numpy
 
-class Transformer():
-    """
-    Represents an abstract transfromation type
-    """
-    def __init__(self, pairsLayer, restrictToSelection):
-
-        self.pointsA = []
-        self.pointsB = []
-        features = pairsLayer.getFeatures() if not restrictToSelection else pairsLayer.selectedFeatures()
-
-        for feature in features:
-            geom = feature.geometry().asPolyline()
-            self.pointsA.append( QgsPointXY(geom[0].x(),geom[0].y()) )
-            self.pointsB.append( QgsPointXY(geom[-1].x(),geom[-1].y()) )
+from .vectorbendercore import *
 
-    def map(self, p):
-        return p
+def readPairs(pairsLayer, restrictToSelection):
+    """ Returns the (ax, ay, bx, by) arrays of the first and last points of the lines of the pairs layer """
+    request = QgsFeatureRequest().setNoAttributes()
+    if restrictToSelection:
+        request.setFilterFids( pairsLayer.selectedFeatureIds() )
 
-class BendTransformer(Transformer):
-    def __init__(self, pairsLayer, restrictToSelection, buff):
+    coords = array.array('d')
+    for feature in pairsLayer.getFeatures(request):
+        geom = feature.geometry().asPolyline()
+        coords.extend( (geom[0].x(), geom[0].y(), geom[-1].x(), geom[-1].y()) )
 
-        Transformer.__init__(self, pairsLayer, restrictToSelection)
+    coords = numpy.frombuffer(coords, dtype=numpy.float64).reshape(-1,4)
+    return tuple( numpy.ascontiguousarray(coords[:,i]) for i in range(4) )
 
-        # Make sure data is valid
-        assert len(self.pointsA)>=3
-        assert len(self.pointsA)==len(self.pointsB)
-
-        self.hull = QgsGeometry.fromMultiPointXY( self.pointsA ).convexHull()
-
-        # If there is a buffer, we add a ring outside the hull so that the transformation smoothly stops
-        if buff>0:
-            self.expandedHull = self.hull.buffer(buff, 3)
-            for p in self.expandedHull.asPolygon()[0]:
-                self.pointsA.append( p )
-                self.pointsB.append( p )
-        else:
-            self.expandedHull = None
+def polygonFromArrays(xs, ys):
+    """ Returns a QgsGeometry polygon from the (not closed) arrays of its vertices """
+    ring = [QgsPointXY(float(x),float(y)) for x,y in zip(xs,ys)]
+    return QgsGeometry.fromPolygonXY( [ring+ring[:1]] )
 
-        # We compute the delaunay        
-        self.delaunay = matplotlib.tri.Triangulation([p.x() for p in self.pointsA],[p.y() for p in self.pointsA])
-        self.trifinder = self.delaunay.get_trifinder()
-
-    def map(self, p):
-
-        triangle = self.trifinder( p[0], p[1] )
+def geometryPoints(geom):
+    """
+    Returns (depth, points, fromPoints) for the geometry : the nested lists of QgsPointXY of the geometry (depth being
+    their nesting level, 0 for a single point) and the function building a geometry from such lists, or None if the
+    geometry type isn't supported
+    """
+    if geom.type() == QgsWkbTypes.PointGeometry:
+        return (1, geom.asMultiPoint(), QgsGeometry.fromMultiPointXY) if geom.isMultipart() else (0, geom.asPoint(), QgsGeometry.fromPointXY)
+    elif geom.type() == QgsWkbTypes.LineGeometry:
+        return (2, geom.asMultiPolyline(), QgsGeometry.fromMultiPolylineXY) if geom.isMultipart() else (1, geom.asPolyline(), QgsGeometry.fromPolylineXY)
+    elif geom.type() == QgsWkbTypes.PolygonGeometry:
+        return (3, geom.asMultiPolygon(), QgsGeometry.fromMultiPolygonXY) if geom.isMultipart() else (2, geom.asPolygon(), QgsGeometry.fromPolygonXY)
+    return None
+
+def flattenPoints(points, depth, flat):
+    if depth == 0:
+        flat.append( points )
+    else:
+        for p in points:
+            flattenPoints(p, depth-1, flat)
+
+def nestPoints(points, depth, mapped):
+    """ Returns the same nested lists as points, with the points taken in order from the mapped iterator """
+    if depth == 0:
+        return next(mapped)
+    return [nestPoints(p, depth-1, mapped) for p in points]
 
-        if triangle==-1:
-            # No triangle found : don't change the point
-            return QgsPointXY(p[0], p[1])
-        else:
-            # Triangle found : adapt it from the old mesh to the new mesh
-            a1 = self.pointsA[self.delaunay.triangles[triangle][0]]
-            a2 = self.pointsA[self.delaunay.triangles[triangle][1]]
-            a3 = self.pointsA[self.delaunay.triangles[triangle][2]]
-
-            b1 = self.pointsB[self.delaunay.triangles[triangle][0]]
-            b2 = self.pointsB[self.delaunay.triangles[triangle][1]]
-            b3 = self.pointsB[self.delaunay.triangles[triangle][2]]
-
-            mappedP = self.mapPointFromTriangleAtoTriangleB(p, a1, a2, a3, b1, b2, b3)
-
-            return mappedP
-
-    def mapPointFromTriangleAtoTriangleB(self, p, a1,a2,a3, b1,b2,b3 ):
-        cT = self.fromCartesianToTriangular( p, a1, a2, a3  )
-        cC = self.fromTriangularToCartesian( cT, b1, b2, b3  )
-        return cC
-
-    def fromCartesianToTriangular(self, p, t1, t2, t3):
-        """ Returns triangular coordinates (l1, l2, l3) for a given point in a given triangle """
-        """ p is a duplet for cartesian coordinates coordinates """
-        x,y = p
-        x1,y1 = t1.x(),t1.y()
-        x2,y2 = t2.x(),t2.y()
-        x3,y3 = t3.x(),t3.y()
-        l1 = ((y2-y3)*(x-x3)+(x3-x2)*(y-y3))/((y2-y3)*(x1-x3)+(x3-x2)*(y1-y3))
-        l2 = ((y3-y1)*(x-x3)+(x1-x3)*(y-y3))/((y2-y3)*(x1-x3)+(x3-x2)*(y1-y3))
-        l3 = 1-l1-l2
-        return (l1,l2,l3)
-
-    def fromTriangularToCartesian(self, l,t1,t2,t3):
-        """ l is a triplet for barycentric coordinates """
-        x = l[0]*t1.x()+l[1]*t2.x()+l[2]*t3.x()
-        y = l[0]*t1.y()+l[1]*t2.y()+l[2]*t3.y()
-        return QgsPointXY(x,y)
+class Transformer():
+    """
+    Represents an abstract transfromation type
 
-class AffineTransformer(Transformer):
+    Transformers adapt the models of vectorbendercore (which do all the math on arrays of coordinates) to QGIS layers,
+    points and geometries. This base transformer only reads the pairs and doesn't change the points.
+    """
     def __init__(self, pairsLayer, restrictToSelection):
-        Transformer.__init__(self, pairsLayer, restrictToSelection)
 
-        # Make sure data is valid
-        assert len(self.pointsA)==3
-        assert len(self.pointsA)==len(self.pointsB)
+        self.ax, self.ay, self.bx, self.by = readPairs(pairsLayer, restrictToSelection)
+        self.model = Model()
 
-        self.a1 = self.pointsA[0]
-        self.a2 = self.pointsA[1]
-        self.a3 = self.pointsA[2]
-        self.b1 = self.pointsB[0]
-        self.b2 = self.pointsB[1]
-        self.b3 = self.pointsB[2]
+    def map(self, p):
+        x, y = self.model.mapPoint(p.x(), p.y())
+        return QgsPointXY(x, y)
 
+    def mapArrays(self, xs, ys):
+        """ Maps arrays of x and y coordinates at once, returns a tuple of arrays """
+        return self.model.mapArrays(xs, ys)
 
+    def mapGeometries(self, geoms):
         """
-
-        MATRIX
-
-            [a,b,c] 
-        M = [d,e,f] 
-            [0,0,1]
-            
-               [x11]   [x12]
-        1] M * [y11] = [y12]
-               [ 1 ]   [ 1 ]
-
-               [x21]   [x22]
-        2] M * [y21] = [y22]
-               [ 1 ]   [ 1 ]
-
-               [x31]   [x32]
-        3] M * [y31] = [y32]
-               [ 1 ]   [ 1 ]
-
-               Equations to solve
-        [ 
-            a*x11+b*y11+c = x12,
-            d*x11+e*y11+f = y12,
-            a*x21+b*y21+c = x22,
-            d*x21+e*y21+f = y22,
-            a*x31+b*y31+c = x32,
-            d*x31+e*y31+f = y32]
-        For variables
-        [a,b,c,d,e,f]
-
-        Result using http://www.numberempire.com/equationsolver.php
-
-        a = (x12*(y31-y21)-x22*y31+x32*y21+(x22-x32)*y11)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        b = (x11*(x32-x22)-x21*x32+x22*x31+x12*(x21-x31))/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        c = -(x11*(x32*y21-x22*y31)+x12*(x21*y31-x31*y21)+(x22*x31-x21*x32)*y11)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        d = (y21*y32+y11*(y22-y32)+y12*(y31-y21)-y22*y31)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        e = -(x21*y32+x11*(y22-y32)-x31*y22+(x31-x21)*y12)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        f = (x11*(y22*y31-y21*y32)+y11*(x21*y32-x31*y22)+y12*(x31*y21-x21*y31))/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-
+        Returns new geometries with all the vertices of geoms mapped. The vertices of all the geometries go through a
+        single mapArrays call, so that models can handle them together (the tiled model needs each tile mesh once).
+        Geometries that the transformation doesn't move at all are returned as is (the same object), so that callers
+        can tell them apart with "is"
         """
+        structures = [geometryPoints(geom) for geom in geoms]
+
+        flat = []
+        ends = []
+        for structure in structures:
+            if structure is not None:
+                flattenPoints(structure[1], structure[0], flat)
+            ends.append( len(flat) )
+        if not flat:
+            return list(geoms)
+
+        xs = numpy.array( [p.x() for p in flat] )
+        ys = numpy.array( [p.y() for p in flat] )
+        mx, my = self.mapArrays( xs, ys )
+        moved = numpy.logical_or( mx != xs, my != ys )
+
+        newGeoms = []
+        start = 0
+        for geom, structure, end in zip(geoms, structures, ends):
+            if structure is None or not moved[start:end].any():
+                # Unmoved, or FALLBACK like mapGeometry
+                newGeoms.append( geom )
+            else:
+                depth, points, fromPoints = structure
+                mapped = (QgsPointXY(x, y) for x, y in zip(mx[start:end].tolist(), my[start:end].tolist()))
+                newGeoms.append( fromPoints( nestPoints(points, depth, mapped) ) )
+            start = end
+        return newGeoms
+
+    def mapGeometry(self, geom):
+        """ Returns a new geometry with all the vertices of geom mapped """
+
+        #TODO : this cood be much simple if we could iterate through to vertices and use QgsGeometry.moveVertex(x,y,index), but QgsGeometry.vertexAt(index) doesn't tell wether the index exists, so there's no clean way to iterate...
+
+        if geom.type() == QgsWkbTypes.PointGeometry:
+
+            if not geom.isMultipart():
+                # SINGLE PART POINT
+                p = geom.asPoint()
+                newGeom = QgsGeometry.fromPointXY( self.map(p) )
+
+            else:
+                # MULTI PART POINT
+                listA = geom.asMultiPoint()
+                newListA = []
+                for p in listA:
+                    newListA.append( self.map(p) )
+                newGeom = QgsGeometry.fromMultiPointXY( newListA )
+
+        elif geom.type() == QgsWkbTypes.LineGeometry:
+
+            if not geom.isMultipart():
+                # SINGLE PART LINESTRING
+                listA = geom.asPolyline()
+                newListA = []
+                for p in listA:
+                    newListA.append( self.map(p) )
+                newGeom = QgsGeometry.fromPolylineXY( newListA )
+
+            else:
+                # MULTI PART LINESTRING
+                listA = geom.asMultiPolyline()
+                newListA = []
+                for listB in listA:
+                    newListB = []
+                    for p in listB:
+                        newListB.append( self.map(p) )
+                    newListA.append( newListB )
+                newGeom = QgsGeometry.fromMultiPolylineXY( newListA )
+
+        elif geom.type() == QgsWkbTypes.PolygonGeometry:
+
+            if not geom.isMultipart():
+                # SINGLE PART POLYGON
+                listA = geom.asPolygon()
+                newListA = []
+                for listB in listA:
+                    newListB = []
+                    for p in listB:
+                        newListB.append( self.map(p) )
+                    newListA.append( newListB )
+                newGeom = QgsGeometry.fromPolygonXY( newListA )
+
+            else:
+                # MULTI PART POLYGON
+                listA = geom.asMultiPolygon()
+                newListA = []
+                for listB in listA:
+                    newListB = []
+                    for listC in listB:
+                        newListC = []
+                        for p in listC:
+                            newListC.append( self.map(p) )
+                        newListB.append( newListC )
+                    newListA.append( newListB )
+                newGeom = QgsGeometry.fromMultiPolygonXY( newListA )
 
-        x11 = self.a1.x()
-        y11 = self.a1.y()
-        x21 = self.a2.x()
-        y21 = self.a2.y()
-        x31 = self.a3.x()
-        y31 = self.a3.y()
-        x12 = self.b1.x()
-        y12 = self.b1.y()
-        x22 = self.b2.x()
-        y22 = self.b2.y()
-        x32 = self.b3.x()
-        y32 = self.b3.y()
-
-        self.a = (x12*(y31-y21)-x22*y31+x32*y21+(x22-x32)*y11)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        self.b = (x11*(x32-x22)-x21*x32+x22*x31+x12*(x21-x31))/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        self.c = -(x11*(x32*y21-x22*y31)+x12*(x21*y31-x31*y21)+(x22*x31-x21*x32)*y11)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        self.d = (y21*y32+y11*(y22-y32)+y12*(y31-y21)-y22*y31)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        self.e = -(x21*y32+x11*(y22-y32)-x31*y22+(x31-x21)*y12)/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
-        self.f = (x11*(y22*y31-y21*y32)+y11*(x21*y32-x31*y22)+y12*(x31*y21-x21*y31))/(x11*(y31-y21)-x21*y31+x31*y21+(x21-x31)*y11)
+        else:
+            # FALLBACK, JUST IN CASE ;)
+            newGeom = geom
 
+        return newGeom
 
-    def map(self, p):
+class BendTransformer(Transformer):
+    def __init__(self, pairsLayer, restrictToSelection, buff):
 
-        return QgsPointXY( self.a*p.x()+self.b*p.y()+self.c, self.d*p.x()+self.e*p.y()+self.f )
-        
-class LinearTransformer(Transformer):
-    def __init__(self, pairsLayer, restrictToSelection):
         Transformer.__init__(self, pairsLayer, restrictToSelection)
 
-        # Make sure data is valid
-        assert len(self.pointsA)==2
-        assert len(self.pointsA)==len(self.pointsB)
+        self.model = BendModel(self.ax, self.ay, self.bx, self.by, buff)
+
+        # Geometries and mesh used by the preview
+        self.hull = polygonFromArrays(self.model.hullX, self.model.hullY)
+        self.expandedHull = polygonFromArrays(self.model.ringX, self.model.ringY) if self.model.ringX is not None else None
+        self.delaunay = self.model.delaunay
 
-        self.a1 = self.pointsA[0]
-        self.a2 = self.pointsA[1]
-        self.b1 = self.pointsB[0]
-        self.b2 = self.pointsB[1]
+class TiledBendTransformer(Transformer):
+    """
+    Bending transformation for very large pairs networks, with one lazily built mesh per tile (see TiledBendModel)
+    """
+    def __init__(self, pairsLayer, restrictToSelection, buff, tileSize, maxTiles=TiledBendModel.MAX_TILES):
 
-        #scale 
-        self.ds = math.sqrt( (self.b2.x()-self.b1.x())**2.0+(self.b2.y()-self.b1.y())**2.0 ) / math.sqrt( (self.a2.x()-self.a1.x())**2.0+(self.a2.y()-self.a1.y())**2.0 )
-        #rotation
-        self.da =  math.atan2( self.b2.y()-self.b1.y(), self.b2.x()-self.b1.x() ) - math.atan2( self.a2.y()-self.a1.y(), self.a2.x()-self.a1.x() )
-        #translation
-        self.dx1 = self.pointsA[0].x()
-        self.dy1 = self.pointsA[0].y() 
-        self.dx2 = self.pointsB[0].x()
-        self.dy2 = self.pointsB[0].y()
+        Transformer.__init__(self, pairsLayer, restrictToSelection)
 
+        self.model = TiledBendModel(self.ax, self.ay, self.bx, self.by, buff, tileSize, maxTiles)
 
-    def map(self, p):
+class AffineTransformer(Transformer):
+    def __init__(self, pairsLayer, restrictToSelection):
 
-        #move to origin (translation part 1)
-        p = QgsPointXY( p.x()-self.dx1, p.y()-self.dy1 )
+        Transformer.__init__(self, pairsLayer, restrictToSelection)
 
-        #scale 
-        p = QgsPointXY( self.ds*p.x(), self.ds*p.y() )
+        self.model = AffineModel(self.ax, self.ay, self.bx, self.by)
 
-        #rotation
-        p = QgsPointXY( math.cos(self.da)*p.x() - math.sin(self.da)*p.y(), math.sin(self.da)*p.x() + math.cos(self.da)*p.y() )
+class LinearTransformer(Transformer):
+    def __init__(self, pairsLayer, restrictToSelection):
 
-        #remove to right spot (translation part 2)
-        p = QgsPointXY( p.x()+self.dx2, p.y()+self.dy2 )
+        Transformer.__init__(self, pairsLayer, restrictToSelection)
 
-        return p
+        self.model = LinearModel(self.ax, self.ay, self.bx, self.by)
 
 class TranslationTransformer(Transformer):
     def __init__(self, pairsLayer, restrictToSelection):
+
         Transformer.__init__(self, pairsLayer, restrictToSelection)
 
-        # Make sure data is valid
-        assert len(self.pointsA)==1 
-        assert len(self.pointsA)==len(self.pointsB)
+        self.model = TranslationModel(self.ax, self.ay, self.bx, self.by)
 
-        self.dx = self.pointsB[0].x()-self.pointsA[0].x()
-        self.dy = self.pointsB[0].y()-self.pointsA[0].y()
+class GridTransformer(Transformer):
+    """
+    Grid evaluation mode : maps points through the DisplacementGrid of a transformer, falling back to the
+    transformer itself for points that are outside of the grid
+    """
+    def __init__(self, transformer, grid):
+        self.ax, self.ay, self.bx, self.by = transformer.ax, transformer.ay, transformer.bx, transformer.by
+        self.grid = grid
+        self.model = GridModel(transformer.model, grid)
 
-    def map(self, p):
-        return QgsPointXY(p[0]+self.dx, p[1]+self.dy)
+class ReprojectedTransformer(Transformer):
+    """
+    Maps the geometries of a layer whose CRS differs from the one of the pairs : the vertices of each geometry are
+    transformed to the CRS of the pairs in one go, mapped by the wrapped transformer and transformed back, so that the
+    layer doesn't need to be reprojected first. Only points and geometries are mapped : coordinates arrays are in
+    the CRS of the pairs, so they are mapped by the wrapped transformer directly
+    """
+    def __init__(self, transformer, layerCrs, pairsCrs, transformContext):
+        self.ax, self.ay, self.bx, self.by = transformer.ax, transformer.ay, transformer.bx, transformer.by
+        self.transformer = transformer
+        self.layerCrs = layerCrs
+        self.pairsCrs = pairsCrs
+        self.transformContext = transformContext
+
+        # QgsCoordinateTransform isn't thread-safe, each worker thread gets its own
+        self.local = threading.local()
+
+    def coordinateTransforms(self):
+        """ Returns the (toPairs, fromPairs) coordinate transforms of the current thread """
+        if not hasattr(self.local, 'toPairs'):
+            self.local.toPairs = QgsCoordinateTransform(self.layerCrs, self.pairsCrs, self.transformContext)
+            self.local.fromPairs = QgsCoordinateTransform(self.pairsCrs, self.layerCrs, self.transformContext)
+        return self.local.toPairs, self.local.fromPairs
 
+    def map(self, p):
+        toPairs, fromPairs = self.coordinateTransforms()
+        return fromPairs.transform( self.transformer.map( toPairs.transform(p) ) )
+
+    def mapGeometry(self, geom):
+        toPairs, fromPairs = self.coordinateTransforms()
+        newGeom = QgsGeometry(geom)
+        newGeom.transform( toPairs )
+        newGeom = self.transformer.mapGeometry( newGeom )
+        newGeom.transform( fromPairs )
+        return newGeom
+
+    def mapGeometries(self, geoms):
+        toPairs, fromPairs = self.coordinateTransforms()
+        reprojected = []
+        for geom in geoms:
+            newGeom = QgsGeometry(geom)
+            newGeom.transform( toPairs )
+            reprojected.append( newGeom )
+        newGeoms = self.transformer.mapGeometries( reprojected )
+        for i, newGeom in enumerate(newGeoms):
+            if newGeom is reprojected[i]:
+                # Unmoved : the original geometry is returned rather than a round trip through both CRS, which isn't exact
+                newGeoms[i] = geoms[i]
+            else:
+                newGeom.transform( fromPairs )
+        return newGeoms